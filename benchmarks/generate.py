@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+r"""
+Synthetic calendars and address books
+=====================================
+
+Realistic large inputs for the benchmarks: single, all-day and multi-day
+events, repeating events with exceptions and changed occurrences, alarms, and
+address books with the usual vCard fields.
+"""
+# License: GPL-3
+
+import random
+from datetime import datetime, timedelta
+
+WEEKDAYS = ("MO", "TU", "WE", "TH", "FR", "SA", "SU")
+WORDS = (
+    "dragon feed forest hunt meeting review plan train office volcano crisis "
+    "lunch team budget release sync garden travel call workshop"
+).split()
+
+
+def words(rand, count):
+    "Random text of COUNT words"
+    return " ".join(rand.choice(WORDS) for _ in range(count))
+
+
+def stamp(date_time):
+    "Local DATE-TIME text"
+    return date_time.strftime("%Y%m%dT%H%M%S")
+
+
+def vevent(rand, uid, start, lines):
+    "VEVENT text with a summary, description and the extra LINES"
+    body = [
+        "BEGIN:VEVENT",
+        f"UID:{uid}",
+        f"DTSTAMP:{stamp(start)}Z",
+        f"SUMMARY:{words(rand, 3).capitalize()}",
+        f"DESCRIPTION:{words(rand, rand.randint(0, 40))}",
+        *lines,
+    ]
+    if rand.random() < 0.3:
+        body.append(f"LOCATION:{words(rand, 2)}")
+    if rand.random() < 0.4:
+        body.append(f"CATEGORIES:{','.join(rand.sample(WORDS, 2))}")
+    if rand.random() < 0.3:
+        body += [
+            "BEGIN:VALARM",
+            "ACTION:DISPLAY",
+            f"TRIGGER:-PT{rand.choice((5, 10, 15, 30, 60))}M",
+            "END:VALARM",
+        ]
+    body.append("END:VEVENT")
+    return body
+
+
+def single_event(rand, uid, start):
+    "Timed, all-day or multi-day event"
+    kind = rand.random()
+    if kind < 0.2:
+        day = start.date()
+        end = day + timedelta(rand.choice((1, 1, 1, 2, 5)))
+        lines = [f"DTSTART;VALUE=DATE:{day:%Y%m%d}", f"DTEND;VALUE=DATE:{end:%Y%m%d}"]
+    elif kind < 0.3:
+        lines = [
+            f"DTSTART;TZID=Europe/Berlin:{stamp(start)}",
+            f"DURATION:PT{rand.choice((1, 2, 3))}H",
+        ]
+    else:
+        end = start + timedelta(minutes=rand.choice((30, 60, 90, 120)))
+        lines = [
+            f"DTSTART;TZID=Europe/Berlin:{stamp(start)}",
+            f"DTEND;TZID=Europe/Berlin:{stamp(end)}",
+        ]
+    return vevent(rand, uid, start, lines)
+
+
+def repeating_event(rand, uid, start):
+    "Repeating event with exceptions, followed by its changed occurrences"
+    rules = [
+        ("FREQ=DAILY", timedelta(1)),
+        (f"FREQ=DAILY;INTERVAL={rand.randint(2, 4)}", None),
+        (f"FREQ=WEEKLY;BYDAY={','.join(rand.sample(WEEKDAYS[:5], 2))}", None),
+        ("FREQ=WEEKLY", timedelta(7)),
+        (f"FREQ=WEEKLY;INTERVAL=2;BYDAY={rand.choice(WEEKDAYS)}", None),
+        ("FREQ=MONTHLY;BYDAY=WE;BYSETPOS=4", None),
+        ("FREQ=MONTHLY", None),
+        ("FREQ=YEARLY", None),
+    ]
+    rule, step = rand.choice(rules)
+    limit = rand.random()
+    if limit < 0.2:
+        rule += f";COUNT={rand.randint(5, 500)}"
+    elif limit < 0.4:
+        until = start + timedelta(rand.randint(30, 3000))
+        rule += f";UNTIL={stamp(until)}Z"
+
+    end = start + timedelta(minutes=rand.choice((15, 30, 60)))
+    lines = [
+        f"DTSTART;TZID=Europe/Berlin:{stamp(start)}",
+        f"DTEND;TZID=Europe/Berlin:{stamp(end)}",
+        f"RRULE:{rule}",
+    ]
+    moved = []
+    if step is not None:
+        days = rand.sample(range(1, 400), rand.randint(0, 4))
+        for day in days[: len(days) // 2]:
+            lines.append(f"EXDATE;TZID=Europe/Berlin:{stamp(start + day * step)}")
+        moved = [start + day * step for day in days[len(days) // 2 :]]
+
+    blocks = [vevent(rand, uid, start, lines)]
+    for original in moved:
+        later = original + timedelta(hours=rand.randint(1, 5))
+        blocks.append(
+            vevent(
+                rand,
+                uid,
+                later,
+                [
+                    f"RECURRENCE-ID;TZID=Europe/Berlin:{stamp(original)}",
+                    f"DTSTART;TZID=Europe/Berlin:{stamp(later)}",
+                    f"DTEND;TZID=Europe/Berlin:{stamp(later + (end - start))}",
+                ],
+            )
+        )
+    return [line for block in blocks for line in block]
+
+
+def calendar(events, seed=0, now=None, years=10):
+    "Icalendar text with about EVENTS events spread over the past YEARS"
+    rand = random.Random(seed)
+    now = now or datetime.now().replace(second=0, microsecond=0)
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//benchmarks//EN"]
+    for index in range(events):
+        start = now - timedelta(
+            days=rand.randint(-60, 365 * years), minutes=15 * rand.randint(0, 96)
+        )
+        uid = f"event-{seed}-{index}"
+        if rand.random() < 0.25:
+            lines += repeating_event(rand, uid, start)
+        else:
+            lines += single_event(rand, uid, start)
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(lines) + "\r\n"
+
+
+def vcard(rand, index):
+    "vCard text of a contact"
+    given, family = words(rand, 1).capitalize(), words(rand, 1).capitalize()
+    lines = [
+        "BEGIN:VCARD",
+        "VERSION:3.0",
+        "PRODID:-//benchmarks//EN",
+        f"UID:card-{index}",
+        f"N:{family};{given};;;",
+        f"FN:{given} {family} {index}",
+        f"EMAIL;TYPE=INTERNET,WORK:{given.lower()}.{index}@example.com",
+        f"TEL;TYPE=CELL:+43 660 {rand.randint(1000000, 9999999)}",
+        f"REV:{2015 + rand.randint(0, 9)}-0{rand.randint(1, 9)}-1{rand.randint(0, 9)}"
+        f"T1{rand.randint(0, 9)}:00:00Z",
+        f"X-ABUID:{index}",
+    ]
+    if rand.random() < 0.5:
+        lines.append(f"TEL;TYPE=WORK,VOICE:+43 1 {rand.randint(100000, 999999)}")
+    if rand.random() < 0.5:
+        lines.append(f"ADR;TYPE=HOME:;;{words(rand, 2)} {index};Wien;;1010;Austria")
+    if rand.random() < 0.3:
+        lines.append(f"NOTE:{words(rand, rand.randint(1, 30))}")
+    if rand.random() < 0.3:
+        lines.append(f"CATEGORIES:{','.join(rand.sample(WORDS, 2))}")
+    lines.append("END:VCARD")
+    return lines
+
+
+def addressbook(cards, seed=0):
+    "vCard text with CARDS contacts"
+    rand = random.Random(seed)
+    lines = [line for index in range(cards) for line in vcard(rand, index)]
+    return "\r\n".join(lines) + "\r\n"
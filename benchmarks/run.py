@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+r"""
+Benchmark the calendar and contact conversions
+==============================================
+
+Measures the throughput and peak memory of org_events, org_calendar, changev
+and org_contacts on synthetic inputs. Results are stored as JSON, and compared
+with the latest stored run to spot regressions between versions.
+
+    python benchmarks/run.py --events 10000 --cards 5000
+"""
+# License: GPL-3
+
+import argparse
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import generate  # noqa: E402
+from icalendar import Calendar  # type: ignore # noqa: E402
+
+from caldav_to_org import ical2org  # noqa: E402
+from caldav_to_org.cards2org import org_contacts  # noqa: E402
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def measure(function, items, repeat):
+    "Best wall time, items per second and peak memory of calling FUNCTION"
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    best = min(times)
+    return {
+        "seconds": best,
+        "items": items,
+        "items_per_second": items / best if best else None,
+        "peak_mib": peak / 2 ** 20,
+    }
+
+
+def benchmarks(events, cards, repeat, ahead=50, back=14):
+    "Results of every benchmark"
+    ics = generate.calendar(events)
+    vcf = generate.addressbook(cards)
+    records = ical2org.calendar_events(Calendar.from_ical(ics))
+    start, end = ical2org.window(ahead, back)
+
+    groups = {}
+    for record in records:
+        groups.setdefault(record["UID"], []).append(record)
+    changed = [group for group in groups.values() if len(group) > 1]
+
+    def changev():
+        for group in changed:
+            ical2org.changev(list(map(ical2org.OrgEvent, group)), start, end)
+
+    return {
+        "org_events": measure(
+            lambda: list(ical2org.org_events([ics], ahead, back)), events, repeat
+        ),
+        "org_calendar": measure(
+            lambda: list(ical2org.org_calendar(records, start, end)),
+            len(records),
+            repeat,
+        ),
+        "changev": measure(changev, sum(map(len, changed)), repeat),
+        "org_contacts": measure(lambda: list(org_contacts([vcf])), cards, repeat),
+    }
+
+
+def revision():
+    "Git revision of the measured tree"
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def latest(directory):
+    "Most recent stored results, None without any"
+    if not (stored := sorted(glob.glob(os.path.join(directory, "*.json")))):
+        return None
+    with open(stored[-1]) as fid:
+        return json.load(fid)
+
+
+def compare(current, previous):
+    "Print the change of every benchmark against the PREVIOUS results"
+    print(
+        f"{'benchmark':<14}{'seconds':>10}{'items/s':>12}"
+        f"{'peak MiB':>10}{'Δ time':>9}"
+    )
+    for name, result in current["results"].items():
+        change = ""
+        if previous and (before := previous["results"].get(name)):
+            change = f"{result['seconds'] / before['seconds'] - 1:+.0%}"
+        print(
+            f"{name:<14}{result['seconds']:>10.3f}{result['items_per_second']:>12.0f}"
+            f"{result['peak_mib']:>10.1f}{change:>9}"
+        )
+
+
+def parse_arguments():
+    "Parse CLI"
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--cards", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default=RESULTS, help="Results directory")
+    parser.add_argument("--no-save", action="store_true", help="Do not store results")
+    return parser.parse_args()
+
+
+def main():
+    "Run, store and compare the benchmarks"
+    args = parse_arguments()
+    previous = latest(args.output)
+    current = {
+        "revision": revision(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "events": args.events,
+        "cards": args.cards,
+        "results": benchmarks(args.events, args.cards, args.repeat),
+    }
+    compare(current, previous)
+
+    if not args.no_save:
+        os.makedirs(args.output, exist_ok=True)
+        name = f"{current['date'].replace(':', '')}-{current['revision']}.json"
+        with open(os.path.join(args.output, name), "w") as fid:
+            json.dump(current, fid, indent=2)
+
+
+if __name__ == "__main__":
+    main()
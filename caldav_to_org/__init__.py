@@ -12,102 +12,728 @@ Goal of the script
 import argparse
 import asyncio
 import configparser
-import hashlib
+import contextlib
+import json
 import logging
+import math
 import os
+import random
 import re
+import time
+from datetime import date
+from urllib.parse import urlsplit
+from xml.etree.ElementTree import ParseError
 
-import requests
-import aiohttp
-
-from caldav_to_org.ical2org import org_events
-from caldav_to_org.cards2org import org_contacts
+from caldav_to_org import caldav
+from caldav_to_org.downloads import DownloadCache, decode, transcode
+from caldav_to_org.stats import STATS
+from caldav_to_org.writer import OrgWriter
 
 LOGGER = logging.getLogger("Org_calendar")
 LOGGER.addHandler(logging.StreamHandler())
 
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "caldav_to_org",
+)
 
-async def passwordstore(address: str) -> str:
-    """Get password from passwordstore address"""
 
-    process = await asyncio.create_subprocess_shell(
-        f"pass show {address}", stdout=asyncio.subprocess.PIPE
-    )
-    stdout, _ = await process.communicate()
+SECRETS = {}
+LOOKUPS = {}
+
+
+async def pass_show(address: str) -> str:
+    """Decrypt the password at passwordstore address"""
+
+    with STATS.stage("passwordstore"):
+        process = await asyncio.create_subprocess_shell(
+            f"pass show {address}", stdout=asyncio.subprocess.PIPE
+        )
+        stdout, _ = await process.communicate()
 
     if process.returncode == 0:
-        return stdout.decode("utf-8").split()[0]
+        secret = stdout.decode("utf-8").split()[0]
+        SECRETS[address] = time.monotonic(), secret
+        return secret
 
     raise ValueError("Unknown password address")
 
 
-async def download(url, section, force, session):
-    "Return calendar from download or cache"
-    hash_url = hashlib.sha1(url.encode("UTF-8")).hexdigest()[:10]
-    url_file = f"/tmp/agenda-{hash_url}"
-    if not force and os.path.exists(url_file):
-        with open(url_file) as txt:
-            return txt.read()
+async def passwordstore(address: str, ttl=None) -> str:
+    """Get password from passwordstore address
+
+    Passwords are kept for the life of the process, or TTL seconds, and
+    concurrent requests for the same address share a single lookup."""
+
+    if address in SECRETS:
+        fetched, secret = SECRETS[address]
+        if ttl is None or time.monotonic() - fetched < float(ttl):
+            STATS.count("password_cache_hits")
+            return secret
+
+    if address not in LOOKUPS:
+        LOOKUPS[address] = asyncio.ensure_future(pass_show(address))
+        LOOKUPS[address].add_done_callback(lambda _: LOOKUPS.pop(address, None))
+
+    return await LOOKUPS[address]
+
+
+def download_cache(section=None):
+    "Cache of the downloads, at most the cache_size MiB of the config SECTION"
+    size = float((section or {}).get("cache_size", 100)) * 2 ** 20
+    return DownloadCache(os.path.join(CACHE_DIR, "downloads"), size)
+
+
+def use_cache(cache, key, section, force, offline=False):
+    """Whether the cached KEY is used without asking the server
+
+    OFFLINE uses any cached copy, otherwise only one fetched less than the
+    cache_ttl seconds of the config SECTION ago, unless FORCE."""
+    if offline:
+        return cache.fresh(key)
+    if force or (ttl := section.get("cache_ttl")) is None:
+        return False
+    return cache.fresh(key, float(ttl))
+
+
+async def basic_auth(section):
+    "HTTP credentials of the config SECTION"
+    import aiohttp
+
+    return aiohttp.BasicAuth(
+        section["user"],
+        await passwordstore(section["passwordstore"], section.get("password_ttl")),
+    )
+
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def retry_delay(attempt, section, reply=None):
+    """Seconds to wait before retry ATTEMPT, jittered exponential backoff
+
+    A Retry-After of the server is followed, all waits are capped by the
+    max_delay of the config SECTION."""
+    max_delay = float(section.get("max_delay", 300))
+    if reply is not None and (retry_after := reply.headers.get("Retry-After")):
+        try:
+            return min(float(retry_after), max_delay)
+        except ValueError:
+            pass
+    delay = random.uniform(0, float(section.get("backoff", 1)) * 2 ** attempt)
+    return min(delay, max_delay)
+
+
+@contextlib.asynccontextmanager
+async def request(session, method, url, section, **kwargs):
+    """Reply of the SESSION request to URL
+
+    Connection errors, timeouts, server errors and rate limits are retried
+    with backoff as many times as the config SECTION allows."""
+    import aiohttp
+
+    retries = int(section.get("retries", 3))
+    for attempt in range(retries + 1):
+        try:
+            reply = await session.request(method, url, **kwargs)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as error:
+            if attempt == retries:
+                raise
+            LOGGER.info("Retrying %s after: %r", url, error)
+            await asyncio.sleep(retry_delay(attempt, section))
+            continue
+
+        if reply.status in RETRY_STATUS and attempt < retries:
+            LOGGER.info("Retrying %s after status: %s", url, reply.status)
+            reply.release()
+            await asyncio.sleep(retry_delay(attempt, section, reply))
+            continue
+
+        try:
+            yield reply
+        finally:
+            STATS.count("bytes_downloaded", reply.content.total_bytes)
+            reply.release()
+        return
+
+
+def time_window(section):
+    "UTC [now-back;now+ahead] window of the config SECTION"
+    from caldav_to_org.ical2org import window
+
+    return window(int(section.get("ahead", 50)), int(section.get("back", 14)))
+
+
+async def query(url, section, force, session, offline=False):
+    """Return calendar events inside the SECTION's time window
+
+    The server filters the events with a CalDAV calendar-query REPORT, the
+    matching events are merged into a single calendar. OFFLINE uses the cached
+    result of the last query, and without FORCE one younger than the
+    cache_ttl of the SECTION is used as well."""
+    cache = download_cache(section)
+    if use_cache(cache, url, section, force, offline) and (
+        text := cache.get(url)
+    ) is not None:
+        return text
+
+    LOGGER.info("Querying from: %s", url)
+    async with request(
+        session,
+        "REPORT",
+        url,
+        section,
+        auth=await basic_auth(section),
+        headers={"Depth": "1", **caldav.XML_HEADERS},
+        data=caldav.calendar_query(*time_window(section)),
+    ) as reply:
+        if reply.status == 207:
+            text = caldav.merge_calendars(caldav.calendar_data(await reply.text()))
+            # Without validators, the filtered body is never revalidated as the
+            # full calendar
+            cache.put(url, text)
+            return text
+
+        raise ValueError(f"Could not query calendar: {url}\n{reply}")
+
+
+def empty_store():
+    "Resource store before the first sync"
+    return {"token": "", "resources": {}}
+
+
+def store_key(url):
+    "Cache key of the resource store of the collection URL"
+    return f"{url}#sync"
+
+
+def read_store(cache, url):
+    "Sync token and resources of the collection URL, empty when not cached"
+    try:
+        return json.loads(cache.get(store_key(url)) or "")
+    except ValueError:
+        return empty_store()
+
+
+async def multiget(
+    url,
+    hrefs,
+    section,
+    auth,
+    session,
+    batch=100,
+    report=caldav.calendar_multiget,
+    data=caldav.CALENDAR_DATA,
+):
+    """Iterate the (href, properties) of the resources at HREFS of collection URL
+
+    They are asked for in batches with the REPORT body, and only those with
+    DATA are returned."""
+    for i in range(0, len(hrefs), batch):
+        async with request(
+            session,
+            "REPORT",
+            url,
+            section,
+            auth=auth,
+            headers={"Depth": "1", **caldav.XML_HEADERS},
+            data=report(hrefs[i : i + batch]),
+        ) as reply:
+            if reply.status != 207:
+                raise ValueError(f"Could not get resources: {url}\n{reply}")
+            text = await reply.text()
 
-    user = section["user"]
-    password = await passwordstore(section["passwordstore"])
+        for href, _, properties in caldav.responses(text):
+            if data in properties:
+                yield href, properties
+
+
+async def sync(url, section, force, session, offline=False):
+    """Return calendar kept up to date with a WebDAV sync-collection REPORT
+
+    Only the resources changed since the stored sync token are transferred,
+    the calendar is assembled from the local store of resources. FORCE and
+    tokens rejected by the server start over with a full sync, OFFLINE uses
+    the store as is."""
+    cache = download_cache(section)
+    store = empty_store() if force else read_store(cache, url)
+    if store["resources"] and use_cache(
+        cache, store_key(url), section, force, offline
+    ):
+        return caldav.merge_calendars(
+            store["resources"][href] for href in sorted(store["resources"])
+        )
+
+    auth = await basic_auth(section)
+    LOGGER.info("Syncing from: %s", url)
+    truncated = True
+    while truncated:
+        async with request(
+            session,
+            "REPORT",
+            url,
+            section,
+            auth=auth,
+            headers={"Depth": "0", **caldav.XML_HEADERS},
+            data=caldav.sync_collection(store["token"]),
+        ) as reply:
+            text = await reply.text()
+            if store["token"] and reply.status in (403, 409):
+                conditions = caldav.preconditions(text)
+                if conditions is None or caldav.VALID_SYNC_TOKEN in conditions:
+                    LOGGER.info("Sync token expired, full sync of: %s", url)
+                    store = empty_store()
+                    continue
+            if reply.status != 207:
+                raise ValueError(f"Could not sync calendar: {url}\n{reply}")
+
+        truncated = False
+        missing = []
+        for href, status, properties in caldav.responses(text):
+            if status == 404:
+                store["resources"].pop(href, None)
+            elif status == 507:
+                truncated = True
+            elif caldav.CALENDAR_DATA in properties:
+                store["resources"][href] = properties[caldav.CALENDAR_DATA]
+            elif caldav.GETETAG in properties:
+                missing.append(href)
+
+        async for href, properties in multiget(url, missing, section, auth, session):
+            store["resources"][href] = properties[caldav.CALENDAR_DATA]
+        store["token"] = caldav.sync_token(text) or ""
+
+    cache.put(store_key(url), json.dumps(store))
+
+    return caldav.merge_calendars(
+        store["resources"][href] for href in sorted(store["resources"])
+    )
+
+
+def cards_key(url):
+    "Cache key of the rendered contacts of the address book URL"
+    return f"{url}#cards"
+
+
+def read_cards(cache, url):
+    "ETag and org contacts by vCard href of the address book URL, {} if none"
+    try:
+        return json.loads(cache.get(cards_key(url)) or "{}")
+    except ValueError:
+        return {}
+
+
+def card_entries(cards):
+    "Org contacts of the CARDS store, in href order"
+    return [entry for href in sorted(cards) for entry in cards[href][1]]
+
+
+async def card_sync(url, section, force, session, offline=False):
+    """Return the org contacts of the address book URL, rendered per vCard
+
+    A PROPFIND lists the ETag of every vCard, only new and changed ones are
+    fetched by addressbook-multiget REPORTs and rendered. FORCE starts over,
+    OFFLINE uses the stored contacts as is."""
+    cache = download_cache(section)
+    cards = {} if force else read_cards(cache, url)
+    if cards and use_cache(cache, cards_key(url), section, force, offline):
+        return card_entries(cards)
+
+    from caldav_to_org.cards2org import org_contacts
+
+    auth = await basic_auth(section)
+    LOGGER.info("Listing vCards of: %s", url)
+    async with request(
+        session,
+        "PROPFIND",
+        url,
+        section,
+        auth=auth,
+        headers={"Depth": "1", **caldav.XML_HEADERS},
+        data=caldav.propfind_etags(),
+    ) as reply:
+        if reply.status != 207:
+            raise ValueError(f"Could not list address book: {url}\n{reply}")
+        text = await reply.text()
+
+    collection = urlsplit(url).path.rstrip("/")
+    etags = {
+        href: properties[caldav.GETETAG]
+        for href, _, properties in caldav.responses(text)
+        if caldav.GETETAG in properties and href.rstrip("/") != collection
+    }
+    cards = {href: cards[href] for href in etags.keys() & cards.keys()}
+    changed = sorted(
+        href for href, etag in etags.items() if cards.get(href, [None])[0] != etag
+    )
+
+    async for href, properties in multiget(
+        url,
+        changed,
+        section,
+        auth,
+        session,
+        report=caldav.addressbook_multiget,
+        data=caldav.ADDRESS_DATA,
+    ):
+        etag = properties.get(caldav.GETETAG) or etags.get(href)
+        cards[href] = [etag, list(org_contacts([properties[caldav.ADDRESS_DATA]]))]
+    STATS.count("cards_fetched", len(changed))
+
+    cache.put(cards_key(url), json.dumps(cards))
+    return card_entries(cards)
+
+
+async def download(url, section, force, session, offline=False):
+    """Return the calendar bytes from download or cache
+
+    With OFFLINE an existing cache is used as is, with FORCE it is ignored,
+    otherwise it is revalidated with the server by a conditional request
+    unless it is younger than the cache_ttl of the SECTION. The body is cached
+    as sent and returned transcoded to UTF-8 from the charset the server
+    declared, undeclared ones are left to the parser."""
+    cache = download_cache(section)
+    if (cached := cache.utf8(url)) is None:
+        # An unreadable body cannot be revalidated, it is fetched again
+        cache.remove(url)
+    elif use_cache(cache, url, section, force, offline):
+        STATS.count("download_cache_hits")
+        return cached
+
+    headers = {} if force else cache.validators(url)
 
     LOGGER.info("Downloading from: %s", url)
-    async with session.get(url, auth=aiohttp.BasicAuth(user, password)) as reply:
+    async with request(
+        session, "GET", url, section, auth=await basic_auth(section), headers=headers
+    ) as reply:
+        if reply.status == 304 and cached is not None:
+            LOGGER.info("Not modified: %s", url)
+            STATS.count("download_cache_hits")
+            cache.touch(url)
+            return cached
+
         if reply.status == 200:
-            text = await reply.text()
-            with open(url_file, "w") as txt:
-                txt.write(text)
-            return text
+            STATS.count("download_cache_misses")
+            body = await reply.read()
+            cache.put(url, body, reply.headers, reply.charset)
+            return transcode(body, reply.charset)
 
         raise ValueError(f"Could not get calendar: {url}\n{reply}")
 
 
-async def get_resource(config, resource, force):
-    "RESOURCE{calendars,addressbooks} are returned given the CONFIG's urls, FORCE download"
+async def stream_lines(url, section, force, session, offline=False):
+    """Iterate the lines of the calendar at URL as they arrive
+
+    The cache and its validators are used as in download, the body is
+    written to the cache while it is read."""
+    cache = download_cache(section)
+    if not cache.intact(url):
+        cache.remove(url)
+    if not use_cache(cache, url, section, force, offline):
+        headers = {} if force else cache.validators(url)
+
+        LOGGER.info("Streaming from: %s", url)
+        async with request(
+            session,
+            "GET",
+            url,
+            section,
+            auth=await basic_auth(section),
+            headers=headers,
+        ) as reply:
+            if reply.status == 200:
+                STATS.count("download_cache_misses")
+                with cache.writer(url, reply.headers, reply.charset) as fid:
+                    async for line in reply.content:
+                        fid.write(line)
+                        yield decode(line, reply.charset).rstrip("\r\n")
+                return
+
+            if reply.status != 304 or not cache.fresh(url):
+                raise ValueError(f"Could not get calendar: {url}\n{reply}")
+            LOGGER.info("Not modified: %s", url)
+            cache.touch(url)
+
+    STATS.count("download_cache_hits")
+    charset = cache.charset(url)
+    for line in cache.lines(url):
+        yield decode(line, charset).rstrip("\r\n")
+
+
+async def calendar_lines(url, section, force, session, offline=False):
+    "Iterate the lines of the calendar at URL, streamed unless synced or queried"
+    if section.getboolean("sync", False):
+        text = await sync(url, section, force, session, offline)
+    elif section.getboolean("timerange", False):
+        text = await query(url, section, force, session, offline)
+    else:
+        async for line in stream_lines(url, section, force, session, offline):
+            yield line
+        return
 
-    cal = []
-    async with aiohttp.ClientSession() as session:
-        for section in config.sections():
-            for entry in re.split('[ ,]', config[section].get(resource, "")):
-                url = config[section]["url"].format(entry)
-                cal.append(download(url, config[section], force, session))
+    for line in text.splitlines():
+        yield line
 
-        return await asyncio.gather(*cal)
 
+async def stream_calendar(url, section, force, session, offline=False, seen=None):
+    """Iterate the org entries of the calendar at URL while it downloads
 
-def write_agenda(config, args):
-    "Write the agenda to file"
+    Events already SEEN in other calendars are skipped, see EventStream."""
+    from caldav_to_org.ical2org import EventStream
 
-    if args.url:
-        calendars = [requests.get(args.url, auth=("username", "")).text]
-    else:
-        calendars = asyncio.run(get_resource(config, "calendars", args.force))
+    events = EventStream(*time_window(section), seen)
+    async for line in calendar_lines(url, section, force, session, offline):
+        for entry in events.feed(line):
+            yield entry
+
+    for entry in events.close():
+        yield entry
+
+
+async def stream_agenda(config, agenda, force, session, offline=False):
+    """Write the org entries of all calendars to the AGENDA writer as rendered
+
+    The first copy of an event streamed is kept, whatever the duplicates
+    policy."""
+    seen = set()
+    for section in config.sections():
+        for url in resource_urls(config[section], "calendars"):
+            with STATS.stage("stream", url):
+                async for event in stream_calendar(
+                    url, config[section], force, session, offline, seen
+                ):
+                    agenda.write(event)
+
+
+def client_session(config):
+    "HTTP session with the connection limit and timeouts of the CONFIG"
+    import aiohttp
+
+    defaults = config["DEFAULT"]
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit_per_host=int(defaults.get("host_connections", 4))
+        ),
+        timeout=aiohttp.ClientTimeout(
+            connect=float(defaults.get("connect_timeout", 10)),
+            sock_read=float(defaults.get("read_timeout", 60)),
+        ),
+    )
+
+
+def stale_copy(url):
+    "Last cached copy of the resource at URL, None if there is none"
+    cache = download_cache()
+    if (body := cache.utf8(url)) is not None:
+        return body
+
+    if (store := read_store(cache, url))["resources"]:
+        return caldav.merge_calendars(
+            store["resources"][href] for href in sorted(store["resources"])
+        )
+    if cards := read_cards(cache, url):
+        return card_entries(cards)
+    return None
+
+
+async def fetch(url, fetcher, limit):
+    """Result of the FETCHER coroutine for URL, run within the LIMIT semaphore
+
+    When the source fails the last cached copy is used, None without one."""
+    import aiohttp
+
+    async with limit:
+        try:
+            with STATS.stage("download", url):
+                return await fetcher
+        except (
+            ValueError,
+            ParseError,
+            aiohttp.ClientError,
+            asyncio.TimeoutError,
+        ) as error:
+            LOGGER.warning("Could not fetch %s: %s", url, error)
+
+    if (text := stale_copy(url)) is not None:
+        LOGGER.warning("Using stale copy of: %s", url)
+    return text
+
+
+def resource_urls(section, resource):
+    "Urls of the RESOURCE{calendars,addressbooks} of the config SECTION"
+    return [
+        section["url"].format(entry)
+        for entry in re.split('[ ,]', section.get(resource, ""))
+    ]
+
+
+def section_fetches(section, resource, force, session, offline=False):
+    "Pairs of url and fetch coroutine of the RESOURCE of the config SECTION"
+    limit = asyncio.Semaphore(int(section.get("connections", 4)))
+    calendars = resource == "calendars"
+    timerange = calendars and section.getboolean("timerange", False)
+    incremental = section.getboolean("sync", False)
+    fetches = []
+    for url in resource_urls(section, resource):
+        if incremental and not calendars:
+            fetcher = card_sync(url, section, force, session, offline)
+        elif incremental:
+            fetcher = sync(url, section, force, session, offline)
+        elif timerange:
+            fetcher = query(url, section, force, session, offline)
+        else:
+            fetcher = download(url, section, force, session, offline)
+        fetches.append((url, fetch(url, fetcher, limit)))
+    return fetches
+
+
+async def get_resource(config, resource, force, offline=False, session=None):
+    """RESOURCE{calendars,addressbooks} are returned given the CONFIG's urls
+
+    FORCE download or use the OFFLINE cache. Sources that fail are replaced
+    by their last cached copy or left out. Without a SESSION one is opened
+    for the call."""
+
+    if session is None:
+        async with client_session(config) as session:
+            return await get_resource(config, resource, force, offline, session)
+
+    cal = [
+        fetcher
+        for section in config.sections()
+        for _, fetcher in section_fetches(
+            config[section], resource, force, session, offline
+        )
+    ]
+    return [text for text in await asyncio.gather(*cal) if text is not None]
+
+
+async def render_calendars(config, force, session, offline=False, jobs=1):
+    """Org entries of all calendars, each parsed as soon as it is fetched
+
+    Calendars are parsed in a worker thread, or a pool of JOBS processes,
+    while the others still download. Once all are in, copies of events across
+    calendars are dropped following the duplicates policy of the CONFIG and
+    the calendars are rendered. The entries keep the config order."""
+    from caldav_to_org.ical2org import CalendarPool
+
+    start, end = time_window(config["DEFAULT"])
+    policy = config["DEFAULT"].get("duplicates", "sequence")
+
+    with CalendarPool(start, end, CACHE_DIR, jobs, policy) as pool:
+
+        async def parse(fetcher):
+            if (text := await fetcher) is None:
+                return None
+            return await asyncio.wrap_future(pool.parse(text))
+
+        parsed = await asyncio.gather(
+            *(
+                parse(fetcher)
+                for section in config.sections()
+                for _, fetcher in section_fetches(
+                    config[section], "calendars", force, session, offline
+                )
+            )
+        )
+        parsed = [result for result in parsed if result is not None]
+        return await asyncio.to_thread(list, pool.entries(parsed))
+
+
+def save_events(config, events):
+    "Write the org EVENTS to the agenda file, True if its content changed"
+    outfile = os.path.expanduser(config["DEFAULT"]["agenda_outfile"])
+
+    LOGGER.info("Writing calendars to: %s", outfile)
+    with OrgWriter(outfile) as agenda:
+        #agenda.write("# -*- after-save-hook: cal-sync-push; -*-")
+        for event in events:
+            agenda.write(event)
+    STATS.count("events_emitted", agenda.entries)
+    return agenda.changed
+
+
+def save_agenda(config, calendars, jobs=1):
+    "Render the CALENDARS to the agenda file, True if its content changed"
+    from caldav_to_org.ical2org import org_events
 
     ahead = int(config["DEFAULT"].get("ahead", 50))
     back = int(config["DEFAULT"].get("back", 14))
-    outfile = os.path.expanduser(config["DEFAULT"]["agenda_outfile"])
+    policy = config["DEFAULT"].get("duplicates", "sequence")
+    events = org_events(calendars, ahead, back, CACHE_DIR, jobs, policy)
+    return save_events(config, events)
+
+
+def save_contacts(config, addresses, jobs=1):
+    "Render the ADDRESSES to the contacts file, True if its content changed"
+    from caldav_to_org.cards2org import org_contacts
+
+    outfile = os.path.expanduser(config["DEFAULT"]["contacts_outfile"])
+
+    LOGGER.info("Writing contacts to: %s", outfile)
+    with OrgWriter(outfile) as contacts:
+        with STATS.stage("contacts"):
+            for contact in org_contacts(addresses, jobs):
+                contacts.write(contact)
+    STATS.count("contacts_emitted", contacts.entries)
+    return contacts.changed
+
+
+async def write_agenda(config, args, session):
+    "Write the agenda to file"
 
     if args.url:
-        print("\n\n".join(dict.fromkeys(org_events(calendars, ahead, back))))
+        import requests
+        from caldav_to_org.ical2org import org_events
+
+        reply = await asyncio.to_thread(requests.get, args.url, auth=("username", ""))
+        ahead = int(config["DEFAULT"].get("ahead", 50))
+        back = int(config["DEFAULT"].get("back", 14))
+        policy = config["DEFAULT"].get("duplicates", "sequence")
+        # A one off url would evict the caches of the configured agenda
+        events = org_events([reply.content], ahead, back, None, args.jobs, policy)
+        events = dict.fromkeys(events)
+        STATS.count("events_emitted", len(events))
+        print("\n\n".join(events))
         return
 
-    with open(outfile, "w") as fid:
-        LOGGER.info("Writing calendars to: %s", outfile)
-        #fid.write("# -*- after-save-hook: cal-sync-push; -*-\n")
-        fid.write("\n\n".join(dict.fromkeys(org_events(calendars, ahead, back))))
-        fid.write("\n")
+    if args.stream:
+        outfile = os.path.expanduser(config["DEFAULT"]["agenda_outfile"])
+        LOGGER.info("Streaming calendars to: %s", outfile)
+        with OrgWriter(outfile) as agenda:
+            await stream_agenda(config, agenda, args.force, session, args.offline)
+        STATS.count("events_emitted", agenda.entries)
+        return
+
+    events = await render_calendars(
+        config, args.force, session, args.offline, args.jobs
+    )
+    await asyncio.to_thread(save_events, config, events)
 
 
-def write_addressbook(config, args):
+async def write_addressbook(config, args, session):
     "Write Contacts to file"
-    addresses = asyncio.run(get_resource(config, "addressbooks", args.force))
-    outfile = os.path.expanduser(config["DEFAULT"]["contacts_outfile"])
+    addresses = await get_resource(
+        config, "addressbooks", args.force, args.offline, session
+    )
+    await asyncio.to_thread(save_contacts, config, addresses, args.jobs)
+
+
+async def update(config, args):
+    """Write the agenda, and the contacts if asked for
+
+    Both are fetched together over one session, and each file is written as
+    soon as its own sources are in, rendering in a thread meanwhile. Without
+    the contacts, a --url run needs no session."""
+    if args.url and not args.contacts:
+        await write_agenda(config, args, None)
+        return
 
-    with open(outfile, "w") as fid:
-        LOGGER.info("Writing contacts to: %s", outfile)
-        fid.write("\n\n".join(org_contacts(addresses)))
-        fid.write("\n")
+    async with client_session(config) as session:
+        writes = [write_agenda(config, args, session)]
+        if args.contacts:
+            writes.append(write_addressbook(config, args, session))
+        await asyncio.gather(*writes)
 
 
 def get_config(filepath):
@@ -122,15 +748,165 @@ def get_config(filepath):
     return config
 
 
+class Daemon:
+    """Keep the org files of the config file at PATH up to date
+
+    Every section is fetched again after its interval in seconds, with some
+    jitter so that sections do not stay in step. The agenda and contacts are
+    rendered again only when one of their sources changed, or the day did.
+    The config is read again when its file changes."""
+
+    config_check = 30
+
+    def __init__(self, path, args):
+        self.path = os.path.expanduser(path)
+        self.args = args
+        self.resources = ["calendars"] + (["addressbooks"] if args.contacts else [])
+        self.config = None
+        self.mtime = None
+        self.due = {}
+        self.texts = {}
+        self.changed = set()
+        self.day = None
+
+    def reload(self):
+        """Read the config when it is new or its file changed, True if it was read
+
+        A changed config that cannot be parsed, like one saved halfway, is
+        logged and the previous one is kept."""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if self.config is not None and mtime == self.mtime:
+            return False
+
+        try:
+            config = get_config(self.path)
+        except configparser.Error as error:
+            if self.config is None:
+                raise
+            LOGGER.error("Keeping the previous config, could not read it: %s", error)
+            self.mtime = mtime
+            return False
+
+        self.config = config
+        self.mtime = mtime
+        self.due = dict.fromkeys(self.config.sections(), 0)
+        self.texts = {resource: {} for resource in self.resources}
+        self.changed = set(self.resources)
+        return True
+
+    def schedule(self, section, now):
+        "Set when SECTION is fetched next, counting from NOW"
+        interval = float(self.config[section].get("interval", 900))
+        jitter = float(self.config[section].get("jitter", 0.1))
+        self.due[section] = now + interval * (1 + random.uniform(-jitter, jitter))
+
+    def pause(self):
+        "Seconds until the next due section, checking the config meanwhile"
+        wait = min(self.due.values(), default=math.inf) - time.monotonic()
+        return max(0, min(wait, self.config_check))
+
+    async def refresh(self, session, force=False):
+        "Fetch the due sections and render the org files whose sources changed"
+        now = time.monotonic()
+        fetches = []
+        for section in [name for name, due in self.due.items() if due <= now]:
+            self.schedule(section, now)
+            for resource in self.resources:
+                fetches += [
+                    (resource, url, fetcher)
+                    for url, fetcher in section_fetches(
+                        self.config[section], resource, force, session
+                    )
+                ]
+
+        texts = await asyncio.gather(*(fetcher for *_, fetcher in fetches))
+        for (resource, url, _), text in zip(fetches, texts):
+            if text is not None and self.texts[resource].get(url) != text:
+                self.texts[resource][url] = text
+                self.changed.add(resource)
+
+        if (day := date.today()) != self.day:
+            self.day = day
+            self.changed.add("calendars")
+
+        if "calendars" in self.changed:
+            save_agenda(self.config, self.sources("calendars"), self.args.jobs)
+            self.changed.discard("calendars")
+        if "addressbooks" in self.changed:
+            save_contacts(self.config, self.sources("addressbooks"), self.args.jobs)
+            self.changed.discard("addressbooks")
+
+    def sources(self, resource):
+        "Last fetched texts of the RESOURCE, in the order of the config"
+        return [
+            self.texts[resource][url]
+            for section in self.config.sections()
+            for url in resource_urls(self.config[section], resource)
+            if url in self.texts[resource]
+        ]
+
+    async def run(self):
+        "Refresh forever, with a new session whenever the config changes"
+        force = self.args.force
+        self.reload()
+        while True:
+            async with client_session(self.config) as session:
+                while True:
+                    try:
+                        await self.refresh(session, force)
+                        force = False
+                    except (OSError, ValueError, KeyError, configparser.Error) as error:
+                        LOGGER.error("Could not refresh the org files: %s", error)
+                    await asyncio.sleep(self.pause())
+                    if self.reload():
+                        LOGGER.info("Reloaded config from: %s", self.path)
+                        break
+
+
 def parse_arguments():
     "Parse CLI"
     parser = argparse.ArgumentParser(description="Translate CalDav Agenda to orgfile")
     parser.add_argument(
         "-f", "--force", help="Force Download of Caldav files", action="store_true"
     )
+    parser.add_argument(
+        "-o",
+        "--offline",
+        action="store_true",
+        help="Use cached Caldav files without asking the server for changes",
+    )
     parser.add_argument(
         "--contacts", action="store_true", help="Download carddav to org-contacts"
     )
+    parser.add_argument(
+        "-s",
+        "--stream",
+        action="store_true",
+        help="Render calendar events while they download, using little memory",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of processes parsing and rendering calendars and contacts",
+    )
+    parser.add_argument(
+        "-d",
+        "--daemon",
+        action="store_true",
+        help="Keep running, refreshing every section after its interval",
+    )
+    parser.add_argument(
+        "--stats",
+        nargs="?",
+        const="-",
+        metavar="FILE",
+        help="Report stage timings and counters to stderr, or as JSON to FILE",
+    )
     parser.add_argument("-r", "--url", help="force direct download from url no auth")
     parser.add_argument("-v", "--verbose", action="count", default=0)
 
@@ -144,9 +920,16 @@ def main():
     log_level = logging.INFO if args.verbose > 0 else logging.WARNING
     LOGGER.setLevel(log_level)
 
-    config = get_config("~/.calendars.conf")
+    STATS.enabled = args.stats is not None
+    os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
 
-    if args.contacts:
-        write_addressbook(config, args)
+    if args.daemon:
+        with contextlib.suppress(KeyboardInterrupt):
+            asyncio.run(Daemon("~/.calendars.conf", args).run())
+        return
+
+    config = get_config("~/.calendars.conf")
+    asyncio.run(update(config, args))
 
-    write_agenda(config, args)
+    if args.stats is not None:
+        STATS.report(args.stats)
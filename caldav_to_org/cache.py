@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+r"""
+Persistent caches
+=================
+
+Parsed event records are stored keyed by the hash of the calendar text they
+come from, so that unchanged calendars skip the icalendar parser. The records
+of calendars not read in a run are removed after it. Rendered
+org entries are stored by event group together with the window they are
+valid for, so that only changed events are rendered again.
+"""
+# License: GPL-3
+
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+VERSION = 3
+
+FIELDS = (
+    "UID",
+    "SUMMARY",
+    "LOCATION",
+    "DESCRIPTION",
+    "DTSTART",
+    "DTEND",
+    "DURATION",
+    "RRULE",
+    "EXDATE",
+    "RECURRENCE-ID",
+    "CATEGORIES",
+    "VALARM",
+    "SEQUENCE",
+    "LAST-MODIFIED",
+)
+DATES = ("DTSTART", "DTEND", "RECURRENCE-ID", "LAST-MODIFIED")
+
+
+def local_zone():
+    "Description of the local timezone the records were converted in"
+    return [time.timezone, time.altzone, list(time.tzname)]
+
+
+def events_path(cache_dir, text):
+    "Cache file of the event records of the calendar TEXT, str or bytes"
+    if isinstance(text, str):
+        text = text.encode("UTF-8")
+    digest = hashlib.sha1(text).hexdigest()
+    return os.path.join(cache_dir, f"agenda-events-{digest}")
+
+
+def encode_date(value):
+    "Date or datetime VALUE as ISO text"
+    return value.isoformat()
+
+
+def decode_date(value):
+    "Date or datetime from ISO text VALUE"
+    return datetime.fromisoformat(value) if "T" in value else date.fromisoformat(value)
+
+
+def encode(record):
+    "Event RECORD as a list of FIELDS values"
+    values = []
+    for field in FIELDS:
+        value = record.get(field)
+        if value is None:
+            pass
+        elif field in DATES:
+            value = encode_date(value)
+        elif field == "EXDATE":
+            value = list(map(encode_date, value))
+        elif field == "DURATION":
+            value = value.total_seconds()
+        values.append(value)
+    return values
+
+
+def decode(values):
+    "Event record from a list of FIELDS VALUES"
+    record = {}
+    for field, value in zip(FIELDS, values):
+        if value is None:
+            continue
+        if field in DATES:
+            value = decode_date(value)
+        elif field == "EXDATE":
+            value = list(map(decode_date, value))
+        elif field == "DURATION":
+            value = timedelta(seconds=value)
+        record[field] = value
+    return record
+
+
+def load_events(path):
+    "Event records stored at PATH, None if missing or stale"
+    try:
+        with open(path) as fid:
+            stored = json.load(fid)
+    except (OSError, ValueError):
+        return None
+
+    if (
+        stored.get("version") != VERSION
+        or stored.get("fields") != list(FIELDS)
+        or stored.get("zone") != local_zone()
+    ):
+        return None
+
+    return list(map(decode, stored["events"]))
+
+
+def dump_events(path, events):
+    "Store the event records EVENTS at PATH"
+    stored = {
+        "version": VERSION,
+        "fields": FIELDS,
+        "zone": local_zone(),
+        "events": list(map(encode, events)),
+    }
+    # Workers may store identical calendars at once, each in its own file
+    handle, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(handle, "w") as fid:
+            json.dump(stored, fid, separators=(",", ":"))
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def prune_events(cache_dir, keep):
+    "Remove the event records stored in CACHE_DIR, except the paths in KEEP"
+    keep = set(map(os.path.basename, keep))
+    for entry in os.scandir(cache_dir):
+        if entry.name.startswith("agenda-events-") and entry.name not in keep:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(entry.path)
+
+
+def timestamp(date_time):
+    "Epoch seconds of DATE_TIME, None stays None"
+    return None if date_time is None else date_time.timestamp()
+
+
+class RenderCache:
+    """Rendered org entries of event groups
+
+    Entries are keyed by the content of the records of a UID, that covers
+    their SEQUENCE and LAST-MODIFIED. They stay valid while the moving time
+    window neither gains nor loses an occurrence."""
+
+    def __init__(self, cache_dir):
+        self.path = os.path.join(cache_dir, "agenda-render")
+        self.used = {}
+        try:
+            with open(self.path) as fid:
+                stored = json.load(fid)
+        except (OSError, ValueError):
+            stored = {}
+
+        valid = stored.get("version") == VERSION and stored.get("zone") == local_zone()
+        self.entries = stored.get("entries", {}) if valid else {}
+
+    @staticmethod
+    def key(records):
+        "Cache key of the event RECORDS"
+        text = json.dumps(list(map(encode, records)), separators=(",", ":"))
+        return hashlib.sha1(text.encode("UTF-8")).hexdigest()
+
+    def get(self, records, start, end):
+        "Rendered entries of RECORDS, None if to be rendered"
+        key = self.key(records)
+        if (entry := self.entries.get(key)) is None:
+            return None
+
+        entries, old_start, old_end, lower, upper = entry
+        start, end = start.timestamp(), end.timestamp()
+        if (
+            old_start <= start
+            and old_end <= end
+            and (lower is None or lower > start)
+            and (upper is None or upper >= end)
+        ):
+            self.used[key] = entry
+            return entries
+        return None
+
+    def put(self, records, start, end, entries, lower, upper):
+        "Store the rendered ENTRIES of RECORDS valid in the bounds"
+        self.used[self.key(records)] = [
+            entries,
+            start.timestamp(),
+            end.timestamp(),
+            timestamp(lower),
+            timestamp(upper),
+        ]
+
+    def save(self):
+        "Store the entries used in this run"
+        stored = {"version": VERSION, "zone": local_zone(), "entries": self.used}
+        with open(f"{self.path}.tmp", "w") as fid:
+            json.dump(stored, fid, separators=(",", ":"))
+        os.replace(f"{self.path}.tmp", self.path)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+r"""
+CalDAV and CardDAV requests and replies
+=======================================
+
+Bodies for the WebDAV PROPFIND and REPORT requests and helpers to read their
+multistatus replies back into plain icalendar and vCard text.
+"""
+# License: GPL-3
+
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+DAV = "DAV:"
+CALDAV = "urn:ietf:params:xml:ns:caldav"
+CARDDAV = "urn:ietf:params:xml:ns:carddav"
+
+XML_HEADERS = {"Content-Type": "application/xml; charset=utf-8"}
+CALENDAR_DATA = f"{{{CALDAV}}}calendar-data"
+ADDRESS_DATA = f"{{{CARDDAV}}}address-data"
+GETETAG = f"{{{DAV}}}getetag"
+VALID_SYNC_TOKEN = f"{{{DAV}}}valid-sync-token"
+
+
+def utc_stamp(date_time):
+    "UTC datetime as icalendar DATE-TIME text"
+    return date_time.strftime("%Y%m%dT%H%M%SZ")
+
+
+def calendar_query(start, end):
+    "REPORT body asking for every VEVENT overlapping the UTC [START;END] window"
+    return f"""<?xml version="1.0" encoding="utf-8" ?>
+<C:calendar-query xmlns:D="{DAV}" xmlns:C="{CALDAV}">
+  <D:prop>
+    <D:getetag/>
+    <C:calendar-data/>
+  </D:prop>
+  <C:filter>
+    <C:comp-filter name="VCALENDAR">
+      <C:comp-filter name="VEVENT">
+        <C:time-range start="{utc_stamp(start)}" end="{utc_stamp(end)}"/>
+      </C:comp-filter>
+    </C:comp-filter>
+  </C:filter>
+</C:calendar-query>"""
+
+
+def sync_collection(token):
+    "REPORT body asking for the changes of a collection since sync TOKEN"
+    return f"""<?xml version="1.0" encoding="utf-8" ?>
+<D:sync-collection xmlns:D="{DAV}" xmlns:C="{CALDAV}">
+  <D:sync-token>{escape(token)}</D:sync-token>
+  <D:sync-level>1</D:sync-level>
+  <D:prop>
+    <D:getetag/>
+    <C:calendar-data/>
+  </D:prop>
+</D:sync-collection>"""
+
+
+def calendar_multiget(hrefs):
+    "REPORT body asking for the calendar-data of the resources at HREFS"
+    href_list = "\n".join(f"  <D:href>{escape(href)}</D:href>" for href in hrefs)
+    return f"""<?xml version="1.0" encoding="utf-8" ?>
+<C:calendar-multiget xmlns:D="{DAV}" xmlns:C="{CALDAV}">
+  <D:prop>
+    <D:getetag/>
+    <C:calendar-data/>
+  </D:prop>
+{href_list}
+</C:calendar-multiget>"""
+
+
+def propfind_etags():
+    "PROPFIND body asking for the ETag of every resource of a collection"
+    return f"""<?xml version="1.0" encoding="utf-8" ?>
+<D:propfind xmlns:D="{DAV}">
+  <D:prop>
+    <D:getetag/>
+  </D:prop>
+</D:propfind>"""
+
+
+def addressbook_multiget(hrefs):
+    "REPORT body asking for the address-data of the vCards at HREFS"
+    href_list = "\n".join(f"  <D:href>{escape(href)}</D:href>" for href in hrefs)
+    return f"""<?xml version="1.0" encoding="utf-8" ?>
+<A:addressbook-multiget xmlns:D="{DAV}" xmlns:A="{CARDDAV}">
+  <D:prop>
+    <D:getetag/>
+    <A:address-data/>
+  </D:prop>
+{href_list}
+</A:addressbook-multiget>"""
+
+
+def status_code(status):
+    "Numeric code of a 'HTTP/1.1 200 OK' STATUS line"
+    return int(status.split()[1]) if status else 200
+
+
+def responses(multistatus):
+    """Iterate the (href, status, properties) of each MULTISTATUS response
+
+    Properties are the texts of the successfully found properties, status
+    is set on responses without properties, like deleted resources."""
+    root = ElementTree.fromstring(multistatus)
+    for response in root.iter(f"{{{DAV}}}response"):
+        href = response.findtext(f"{{{DAV}}}href", "").strip()
+        status = status_code(response.findtext(f"{{{DAV}}}status"))
+        properties = {}
+        for propstat in response.iter(f"{{{DAV}}}propstat"):
+            props = propstat.find(f"{{{DAV}}}prop")
+            found = status_code(propstat.findtext(f"{{{DAV}}}status")) == 200
+            if props is None or not found:
+                continue
+            for prop in props:
+                properties[prop.tag] = prop.text or ""
+        yield href, status, properties
+
+
+def preconditions(body):
+    "Names of the conditions reported by a DAV:error BODY, None without one"
+    try:
+        root = ElementTree.fromstring(body)
+    except ElementTree.ParseError:
+        return None
+    if root.tag != f"{{{DAV}}}error":
+        return None
+    return {child.tag for child in root}
+
+
+def sync_token(multistatus):
+    "New sync-token of a sync-collection MULTISTATUS reply"
+    return ElementTree.fromstring(multistatus).findtext(f"{{{DAV}}}sync-token")
+
+
+def calendar_data(multistatus):
+    "Iterate the calendar-data texts of a MULTISTATUS reply"
+    root = ElementTree.fromstring(multistatus)
+    for data in root.iter(CALENDAR_DATA):
+        if data.text and data.text.strip():
+            yield data.text
+
+
+def components(ical):
+    "Iterate the text blocks of the components directly inside a VCALENDAR"
+    block = []
+    depth = 0
+    for line in ical.splitlines():
+        if line.startswith("BEGIN:"):
+            depth += 1
+        if depth > 1:
+            block.append(line)
+        if line.startswith("END:"):
+            depth -= 1
+            if depth == 1:
+                yield block[0][len("BEGIN:"):].strip(), "\n".join(block)
+                block = []
+
+
+def merge_calendars(calendars):
+    "Join the components of many VCALENDAR texts into a single calendar"
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//caldav_to_org//EN"]
+    timezones = set()
+    for ical in calendars:
+        for name, block in components(ical):
+            if name == "VTIMEZONE":
+                if block in timezones:
+                    continue
+                timezones.add(block)
+            lines.append(block)
+    lines.append("END:VCALENDAR")
+    return "\n".join(lines)
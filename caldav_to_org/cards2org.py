@@ -2,77 +2,122 @@
 r"""
 Convert Caldav to org-contacts
 ==============================
+
+Plain vCards are read directly from their content lines, skipping ignored
+and X- properties before decoding them. vCards with encoded values,
+quoted parameters or nested components go through vobject, both paths
+render the same entries.
 """
 # Author: Óscar Nájera
 # License: GPL-3
 # Inspired https://gist.github.com/tmalsburg/9747104
 
+import re
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+
 import dateutil.parser
 import vobject  # type: ignore
+from vobject.icalendar import stringToTextValues  # type: ignore
+from vobject.vcard import ADDRESS_ORDER, NAME_ORDER, Address, Name  # type: ignore
+from vobject.vcard import splitFields  # type: ignore
+
 from caldav_to_org import org
 
+IGNORE = ("VERSION", "PRODID", "FN", "NOTE", "CATEGORIES")
+UNFOLD = re.compile(r"(?:\r\n|\r|\n)[\t ]")
+LINE_END = re.compile(r"\r\n|\r|\n")
+HEAD = re.compile(
+    r"(?:[A-Za-z0-9_-]+\.)?([A-Za-z0-9_-]+)((?:;[A-Za-z0-9_-]+(?:=[^\";:]*)?)*)"
+)
+REV = re.compile(
+    r"(\d{4})-(\d\d)-(\d\d)(?:T(\d\d):(\d\d):(\d\d)(?:\.\d+)?)?"
+    r"(?:Z|[+-]\d\d:?\d\d)?"
+    r"|(\d{4})(\d\d)(\d\d)(?:T(\d\d)(\d\d)(\d\d))?(?:Z|[+-]\d\d:?\d\d)?"
+)
+BATCH = 500
+
+
+def revision(value):
+    "Org timestamp of a REV VALUE"
+    if match := REV.fullmatch(value):
+        try:
+            stamp = datetime(*(int(part) for part in match.groups() if part))
+            return stamp.strftime("[%Y-%m-%d %a %H:%M]")
+        except ValueError:
+            pass
+    return dateutil.parser.parse(value).strftime("[%Y-%m-%d %a %H:%M]")
+
+
+def org_property(name, value, types):
+    "Org property of a contact property NAME with native VALUE, None if empty"
+    if name == "N":
+        value = "%s;%s;%s;%s;%s" % (
+            value.family,
+            value.given,
+            value.additional,
+            value.prefix,
+            value.suffix,
+        )
+
+    if name == "ADR":
+        value = (
+            value.street,
+            value.code + " " + value.city,
+            value.region,
+            value.country,
+            value.extended,
+            value.box,
+        )
+        value = ", ".join([x for x in value if x.strip() != ""])
+        name = "ADDRESS"
+
+    if name == "REV":
+        value = revision(value)
+
+    if name == "TEL":
+        name = "PHONE"
+
+    # Collect type attributes:
+    if attribs := ", ".join(types):
+        attribs = " (%s)" % attribs
+
+    # Make sure that there are no newline chars left as that would
+    # break org's property format:
+    if isinstance(value, (list, tuple)):
+        value = ", ".join(value)
+    if value := value.replace("\n", ", "):
+        return name, value + attribs
+    return None
+
 
 def get_properties(contact):
     "Extract all contact elements as properties"
-    ignore = ["VERSION", "PRODID", "FN", "NOTE", "CATEGORIES"]
-
     for prop in contact.getChildren():
-
-        name = prop.name
-        value = prop.value
         # Special treatment for some fields:
-        if prop.name in ignore or prop.name.startswith("X-"):
+        if prop.name in IGNORE or prop.name.startswith("X-"):
             continue
-
-        if prop.name == "N":
-            value = "%s;%s;%s;%s;%s" % (
-                prop.value.family,
-                prop.value.given,
-                prop.value.additional,
-                prop.value.prefix,
-                prop.value.suffix,
-            )
-
-        if prop.name == "ADR":
-            value = (
-                prop.value.street,
-                prop.value.code + " " + prop.value.city,
-                prop.value.region,
-                prop.value.country,
-                prop.value.extended,
-                prop.value.box,
-            )
-            value = ", ".join([x for x in value if x.strip() != ""])
-            name = "ADDRESS"
-
-        if prop.name == "REV":
-            value = dateutil.parser.parse(prop.value)
-            value = value.strftime("[%Y-%m-%d %a %H:%M]")
-
-        if prop.name == "TEL":
-            name = "PHONE"
-
-        # Collect type attributes:
-        if attribs := ", ".join(prop.params.get("TYPE", [])):
-            attribs = " (%s)" % attribs
-
-        # Make sure that there are no newline chars left as that would
-        # break org's property format:
-        if isinstance(value, (list, tuple)):
-            value = ", ".join(value)
-        if value := value.replace("\n", ", "):
-            yield name, value + attribs
+        if prop := org_property(prop.name, prop.value, prop.params.get("TYPE", [])):
+            yield prop
 
 
 class OrgContact(org.OrgEntry):
     "Contact representation in Org-mode"
 
-    def __init__(self, contact):
-        super().__init__(contact)
-        self.property_parser = get_properties
-        self.heading = contact.fn.value
-        self.description = contact.getChildValue("note", "")
-        self.dates = ""
+    __slots__ = ()
+    property_parser = staticmethod(get_properties)
+    dates = ""
+
+    @property
+    def heading(self):
+        "Heading"
+        return self.entry.fn.value
+
+    @property
+    def description(self):
+        "Description"
+        return self.entry.getChildValue("note", "")
 
     @property
     def tags(self):
@@ -80,8 +125,172 @@ class OrgContact(org.OrgEntry):
         return org.tags(self.entry.getChildValue("categories", []))
 
 
-def org_contacts(addressbooks):
-    "Iterate all addressbooks to generate contacts"
-    for book in map(vobject.readComponents, addressbooks):
-        for contact in book:
-            yield str(OrgContact(contact))
+def text_values(text):
+    "Values of a comma separated TEXT list, unescaped"
+    if "\\" in text:
+        return stringToTextValues(text)
+    values = text.split(",")
+    if len(values) > 1 and not values[-1]:
+        values.pop()
+    return values
+
+
+def fields(text):
+    "Values of the semicolon separated fields of a structured TEXT"
+    if "\\" in text:
+        return splitFields(text)
+    values = text.split(";")
+    if len(values) > 1 and not values[-1]:
+        values.pop()
+    return [
+        parts if len(parts := text_values(value)) > 1 else parts[0]
+        for value in values
+    ]
+
+
+def native(name, text):
+    "Value of the property NAME as vobject transforms its TEXT"
+    if name == "N":
+        return Name(**dict(zip(NAME_ORDER, fields(text))))
+    if name == "ADR":
+        return Address(**dict(zip(ADDRESS_ORDER, fields(text))))
+    if name == "ORG":
+        return fields(text)
+    if name == "CATEGORIES":
+        return text_values(text)
+    if name == "GEO":
+        return text
+    return text_values(text)[0]
+
+
+def read_properties(lines):
+    """Properties of the content LINES of a vCard by name, in order
+
+    Each is a list of (text, types), None when the vCard needs vobject."""
+    properties = {}
+    for line in lines:
+        head, colon, text = line.partition(":")
+        if not colon or not (match := HEAD.fullmatch(head)):
+            return None
+        name = match[1].replace("_", "-").upper()
+        if name in ("BEGIN", "END", "PROFILE"):
+            return None
+        if name.startswith("X-") or name in ("VERSION", "PRODID"):
+            continue
+
+        types = []
+        for param in match[2].split(";")[1:]:
+            key, _, values = param.partition("=")
+            if not (values := [value for value in values.split(",") if value]):
+                if key in ("QUOTED-PRINTABLE", "BASE64"):
+                    return None
+            elif (key := key.upper()) in ("ENCODING", "CHARSET"):
+                return None
+            elif key == "TYPE":
+                types += values
+        properties.setdefault(name, []).append((text, types))
+    return properties
+
+
+def fast_contact(lines):
+    "Org entry of the vCard content LINES, None if it needs vobject"
+    if (properties := read_properties(lines[1:-1])) is None or (
+        "FN" not in properties
+    ):
+        return None
+
+    def first(name, default):
+        if name not in properties:
+            return default
+        return native(name, properties[name][0][0])
+
+    drawer = []
+    for name, values in properties.items():
+        if name in IGNORE:
+            continue
+        for text, types in values:
+            if prop := org_property(name, native(name, text), types):
+                drawer.append(prop)
+
+    return org.string(
+        SimpleNamespace(
+            heading=first("FN", None),
+            tags=org.tags(first("CATEGORIES", [])),
+            properties=org.property_box(drawer),
+            dates="",
+            description=first("NOTE", ""),
+        )
+    )
+
+
+def vcards(book):
+    """Content lines of every vCard of the address BOOK, None if irregular
+
+    vCards without VERSION get the one of the vCard before, as vobject
+    reads them."""
+    cards = []
+    card = None
+    version = None
+    for line in LINE_END.split(UNFOLD.sub("", book)):
+        if not line:
+            continue
+        name, _, value = line.partition(":")
+        name = name.upper()
+        if card is None:
+            if name != "BEGIN" or value.upper() != "VCARD":
+                return None
+            card, card_version = [line], None
+        elif name == "BEGIN":
+            return None
+        elif name == "END":
+            if value.upper() != "VCARD":
+                return None
+            card.append(line)
+            if card_version is not None:
+                version = card_version
+            elif version is not None:
+                card.insert(1, version)
+            cards.append(card)
+            card = None
+        else:
+            if name == "VERSION":
+                card_version = line
+            card.append(line)
+    return cards if card is None else None
+
+
+def render_cards(cards):
+    "Org entries of the content lines of CARDS"
+    return [
+        fast_contact(lines) or str(OrgContact(vobject.readOne("\n".join(lines))))
+        for lines in cards
+    ]
+
+
+def org_contacts(addressbooks, jobs=1):
+    """Iterate all addressbooks to generate contacts
+
+    Address books synced per vCard come as lists of rendered contacts, the
+    others as text or downloaded bytes. With more than one JOBS, large address
+    books are rendered in a process pool in batches of vCards, keeping their
+    order."""
+    pool = ProcessPoolExecutor(jobs) if jobs > 1 else None
+    try:
+        for book in addressbooks:
+            if isinstance(book, list):
+                yield from book
+                continue
+            if isinstance(book, bytes):
+                book = book.decode("UTF-8", "replace")
+            if (cards := vcards(book)) is None:
+                for contact in vobject.readComponents(book):
+                    yield str(OrgContact(contact))
+            elif pool is not None and len(cards) > BATCH:
+                batches = (cards[i : i + BATCH] for i in range(0, len(cards), BATCH))
+                for entries in pool.map(render_cards, batches):
+                    yield from entries
+            else:
+                yield from render_cards(cards)
+    finally:
+        if pool is not None:
+            pool.shutdown()
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+r"""
+Cache of downloaded resources
+=============================
+
+Every url has a gzip compressed body and a JSON metadata file with the url,
+the time it was fetched, its validators, its charset and its size. Bodies are
+stored as the bytes the server sent. Reading an entry marks it as recently
+used, and once the bodies take more than the size limit the least recently
+used entries are evicted.
+"""
+# License: GPL-3
+
+import codecs
+import contextlib
+import gzip
+import hashlib
+import json
+import os
+import time
+import zlib
+
+VALIDATORS = {"ETag": "If-None-Match", "Last-Modified": "If-Modified-Since"}
+
+
+def decode(body, charset=None):
+    "Text of BODY in CHARSET, UTF-8 by default, replacing undecodable bytes"
+    try:
+        return body.decode(charset or "UTF-8", "replace")
+    except LookupError:
+        return body.decode("UTF-8", "replace")
+
+
+def transcode(body, charset=None):
+    "BODY in CHARSET as UTF-8 bytes, as is when UTF-8, undeclared or unknown"
+    try:
+        if not charset or codecs.lookup(charset).name == "utf-8":
+            return body
+    except LookupError:
+        return body
+    return decode(body, charset).encode("UTF-8")
+
+
+class DownloadCache:
+    "Compressed resources by url in DIRECTORY, at most MAX_SIZE bytes of them"
+
+    def __init__(self, directory, max_size=100 * 2 ** 20):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def path(self, url):
+        "Body file of URL"
+        digest = hashlib.sha1(url.encode("UTF-8")).hexdigest()
+        return os.path.join(self.directory, f"{digest}.gz")
+
+    @staticmethod
+    def meta_path(body):
+        "Metadata file of the BODY file"
+        return f"{body[:-3]}.json"
+
+    def meta(self, url):
+        "Metadata of the entry of URL, None without one"
+        try:
+            with open(self.meta_path(self.path(url))) as fid:
+                return json.load(fid)
+        except (OSError, ValueError):
+            return None
+
+    def fresh(self, url, max_age=None):
+        "Whether URL is cached, fetched at most MAX_AGE seconds ago if given"
+        if (meta := self.meta(url)) is None:
+            return False
+        return max_age is None or time.time() - meta["fetched"] <= max_age
+
+    def validators(self, url):
+        "Conditional request headers revalidating the entry of URL"
+        stored = (self.meta(url) or {}).get("validators", {})
+        return {VALIDATORS[key]: value for key, value in stored.items()}
+
+    def charset(self, url):
+        "Charset the server declared for the entry of URL, None if unknown"
+        return (self.meta(url) or {}).get("charset")
+
+    def read(self, url, max_age=None):
+        "Cached body of URL, None if missing or older than MAX_AGE seconds"
+        if not self.fresh(url, max_age):
+            return None
+        try:
+            with open(self.path(url), "rb") as fid:
+                body = gzip.decompress(fid.read())
+        except (OSError, EOFError, zlib.error):
+            return None
+        os.utime(self.path(url))
+        return body
+
+    def utf8(self, url, max_age=None):
+        "Cached body of URL transcoded to UTF-8, None as in read"
+        if (body := self.read(url, max_age)) is None:
+            return None
+        return transcode(body, self.charset(url))
+
+    def intact(self, url):
+        "Whether URL is cached with a body that reads back whole"
+        try:
+            with gzip.open(self.path(url)) as fid:
+                while fid.read(2 ** 16):
+                    pass
+        except (OSError, EOFError, zlib.error):
+            return False
+        return self.fresh(url)
+
+    def get(self, url, max_age=None):
+        "Cached text of URL, None if missing or older than MAX_AGE seconds"
+        if (body := self.read(url, max_age)) is None:
+            return None
+        return body.decode("UTF-8")
+
+    def lines(self, url):
+        "Iterate the cached lines of URL, as bytes"
+        os.utime(self.path(url))
+        with gzip.open(self.path(url)) as fid:
+            yield from fid
+
+    def touch(self, url):
+        "Mark the entry of URL as fetched now, after the server confirmed it"
+        if (meta := self.meta(url)) is not None:
+            meta["fetched"] = time.time()
+            self.write_meta(url, meta)
+
+    def put(self, url, body, headers=None, charset=None):
+        "Store the BODY bytes or text as the entry of URL, see writer"
+        if isinstance(body, str):
+            body, charset = body.encode("UTF-8"), "UTF-8"
+        with self.writer(url, headers, charset) as fid:
+            fid.write(body)
+
+    @contextlib.contextmanager
+    def writer(self, url, headers=None, charset=None):
+        """Binary file replacing the entry of URL once closed without error
+
+        The validators of the reply HEADERS and the CHARSET of the body are
+        stored with it."""
+        body = self.path(url)
+        with gzip.open(f"{body}.tmp", "wb") as fid:
+            try:
+                yield fid
+            except BaseException:
+                fid.close()
+                os.remove(f"{body}.tmp")
+                raise
+            size = fid.tell()
+        os.replace(f"{body}.tmp", body)
+
+        headers = headers or {}
+        validators = {key: headers[key] for key in VALIDATORS if key in headers}
+        meta = {
+            "url": url,
+            "fetched": time.time(),
+            "validators": validators,
+            "charset": charset,
+            "size": size,
+        }
+        self.write_meta(url, meta)
+        self.evict(keep=body)
+
+    def write_meta(self, url, meta):
+        "Store the metadata META of URL"
+        path = self.meta_path(self.path(url))
+        with open(f"{path}.tmp", "w") as fid:
+            json.dump(meta, fid)
+        os.replace(f"{path}.tmp", path)
+
+    def remove(self, url):
+        "Forget the entry of URL"
+        self.discard(self.path(url))
+
+    def discard(self, body):
+        "Remove the BODY file and its metadata"
+        for path in (body, self.meta_path(body)):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+    def evict(self, keep=None):
+        "Remove least recently used entries until the bodies fit, except KEEP"
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".gz"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+                total += stat.st_size
+
+        for _, body, size in sorted(entries):
+            if total <= self.max_size:
+                break
+            if body != keep:
+                self.discard(body)
+                total -= size
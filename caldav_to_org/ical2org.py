@@ -7,40 +7,69 @@ Convert icalendar elements into org-mode elements
 # Author: Óscar Nájera
 # License: GPL-3
 
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import lru_cache
+from itertools import repeat
 from dateutil import tz
-from dateutil.rrule import rrulestr
-from icalendar import Calendar  # type: ignore
 from pytz import utc
 from tzlocal import get_localzone  # type: ignore
-from caldav_to_org import org
+from caldav_to_org import cache, org, recurrence
+from caldav_to_org.stats import STATS, reset_worker
 
 # inspiration from
 # https://www.nylas.com/blog/calendar-events-rrules/
 
+# Local time of dates and floating times is within a day of UTC
+SLACK = timedelta(days=1)
+
+
+class OrgStamps:
+    """Org timestamps in the local timezone
+
+    The zone is resolved once and the date part of the stamps, the costly
+    strftime, is memoized."""
+
+    def __init__(self):
+        self.zone = get_localzone()
+        self.tzlocal = tz.tzlocal()
+        self.day = lru_cache(maxsize=4096)(lambda day: day.strftime("<%Y-%m-%d %a"))
+
+    def stamp(self, datestamp, time=True):
+        "Timezone aware datetime to YYYY-MM-DD DayofWeek HH:MM str in localtime."
+        local = datestamp.astimezone(self.zone)
+        if time:
+            return f"{self.day(local.date())} {local.hour:02d}:{local.minute:02d}>"
+        return f"{self.day(local.date())}>"
+
+    def intervals(self, starts, duration):
+        "Write the org intervals of the occurrences at STARTS lasting DURATION"
+        seconds = duration.total_seconds()
+        if seconds % 86400 == 0:
+            if seconds / 86400 > 1:
+                last = duration - timedelta(seconds=1)
+                return "".join(
+                    f"  {self.stamp(start, False)}--{self.stamp(start + last, False)}\n"
+                    for start in starts
+                )
+            return "".join(f"  {self.stamp(start, False)}\n" for start in starts)
+
+        return "".join(
+            f"  {self.stamp(start)}--{self.stamp(start + duration)}\n"
+            for start in starts
+        )
 
-def orgdatetime(datestamp, time_zone, time=True):
-    """Timezone aware datetime to YYYY-MM-DD DayofWeek HH:MM str in localtime.
-    """
-    hours = " %H:%M" if time else ""
-    str_format = f"<%Y-%m-%d %a{hours}>"
-
-    return datestamp.astimezone(time_zone).strftime(str_format)
 
+@lru_cache(maxsize=1)
+def zone_stamps(zone):
+    "Org timestamps of the local ZONE description"
+    return OrgStamps()
 
-def org_interval(start, duration, time_zone):
-    "Write org interval"
-    if duration.total_seconds() % 86400 == 0:
-        datestr = "  {}".format(orgdatetime(start, time_zone, False))
-        if duration.total_seconds() / 86400 > 1:
-            datestr += "--{}".format(
-                orgdatetime(start + duration - timedelta(seconds=1), time_zone, False)
-            )
-        return datestr + "\n"
 
-    return "  {}--{}\n".format(
-        orgdatetime(start, time_zone), orgdatetime(start + duration, time_zone),
-    )
+def local_stamps():
+    "Org timestamps of the current local timezone"
+    return zone_stamps((time.timezone, time.altzone, time.tzname))
 
 
 def put_tz(date_time):
@@ -50,27 +79,105 @@ def put_tz(date_time):
             year=date_time.year,
             month=date_time.month,
             day=date_time.day,
-            tzinfo=tz.tzlocal(),
+            tzinfo=local_stamps().tzlocal,
         )
-    return date_time.astimezone(tz.tzlocal())
+    return date_time.astimezone(local_stamps().tzlocal)
 
 
 def get_properties(event):
     "Extract relevant properties"
     properties = ("LOCATION", "UID")
     for prop in properties:
-        if value := event.get(prop, "").strip():
+        if value := event.get(prop):
             if prop == "UID":
                 prop = "ID"
             yield prop, value
 
     if "RRULE" in event:
-        yield "RRULE", rrule_cleanup(event["RRULE"])
-
-    for comp in event.subcomponents:
-        if comp.name == "VALARM":
-            trigger = int(-1 * comp["TRIGGER"].dt.total_seconds() / 60)
-            yield "APPT_WARNTIME", str(trigger)
+        yield "RRULE", event["RRULE"]
+
+    for trigger in event.get("VALARM", []):
+        yield "APPT_WARNTIME", str(trigger)
+
+
+def event_record(event):
+    """Plain record of the icalendar EVENT fields needed to render it
+
+    Text is decoded, dates are kept as date or datetime and the repetition
+    rule is already cleaned up, so that the record can be stored and rendered
+    without the icalendar component."""
+    record = {
+        "UID": event.get("UID", "").strip(),
+        "SUMMARY": str(event["SUMMARY"]),
+        "LOCATION": event.get("LOCATION", "").strip(),
+        "DESCRIPTION": str(event.get("DESCRIPTION", "")),
+        "DTSTART": event["DTSTART"].dt,
+    }
+    if "DTEND" in event:
+        record["DTEND"] = event["DTEND"].dt
+    elif "DURATION" in event:
+        record["DURATION"] = event["DURATION"].dt
+    if "RRULE" in event:
+        record["RRULE"] = rrule_cleanup(event["RRULE"])
+    if exdates := event.get("EXDATE", []):
+        record["EXDATE"] = [
+            date.dt
+            for dates in ((exdates,) if not isinstance(exdates, list) else exdates)
+            for date in dates.dts
+        ]
+    if "RECURRENCE-ID" in event:
+        record["RECURRENCE-ID"] = event["RECURRENCE-ID"].dt
+    if "SEQUENCE" in event:
+        record["SEQUENCE"] = int(event["SEQUENCE"])
+    if "LAST-MODIFIED" in event:
+        record["LAST-MODIFIED"] = event["LAST-MODIFIED"].dt
+
+    categories = event.get("CATEGORIES", [])
+    if not isinstance(categories, list):
+        categories = [categories]
+    if categories:
+        record["CATEGORIES"] = [
+            x.to_ical().decode("utf-8").replace(" ", "-").replace(",", ":")
+            for x in categories
+        ]
+
+    if alarms := [
+        int(-1 * comp["TRIGGER"].dt.total_seconds() / 60)
+        for comp in event.subcomponents
+        if comp.name == "VALARM"
+    ]:
+        record["VALARM"] = alarms
+
+    return record
+
+
+def moment(value):
+    "Datetime of a date or datetime VALUE, taken as UTC without a timezone"
+    if not hasattr(value, "hour"):
+        return datetime(value.year, value.month, value.day, tzinfo=utc)
+    if value.tzinfo is None:
+        return value.replace(tzinfo=utc)
+    return value
+
+
+def candidate(record, start, end):
+    """Whether the event RECORD may have an occurrence between START and END
+
+    Decided only from DTSTART, the duration and the end of the repetition
+    rule, before building the OrgEvent of the record."""
+    dtstart = moment(record["DTSTART"])
+    if dtstart > end + SLACK:
+        return False
+
+    if "DTEND" in record:
+        duration = moment(record["DTEND"]) - dtstart
+    else:
+        duration = record.get("DURATION", timedelta())
+    last = dtstart
+    if "RRULE" in record:
+        if (last := recurrence.last_start(record["RRULE"], dtstart)) is None:
+            return True
+    return last + max(duration, timedelta()) >= start - SLACK
 
 
 def rrule_cleanup(rrule_conf):
@@ -86,62 +193,56 @@ def rrule_cleanup(rrule_conf):
 def rrule(org_event, exceptions=None):
     "Create event repetition rule"
 
-    rule = rrulestr(
-        rrule_cleanup(org_event.entry["RRULE"]),
-        dtstart=org_event.dtstart,
-        forceset=True,
-    )
-
-    exdates = org_event.entry.get("EXDATE", [])
-    for dates in (exdates,) if not isinstance(exdates, list) else exdates:
-        for date in dates.dts:
-            rule.exdate(put_tz(date.dt))
+    exdates = {put_tz(date) for date in org_event.entry.get("EXDATE", [])}
 
     if exceptions:
-        for date in exceptions:
-            new_datetime = put_tz(date.dt).replace(
+        exdates.update(
+            put_tz(date).replace(
                 hour=org_event.dtstart.hour, minute=org_event.dtstart.minute
             )
-            rule.exdate(new_datetime)
+            for date in exceptions
+        )
 
-    return rule
+    return recurrence.rule(org_event.entry["RRULE"], org_event.dtstart, exdates)
 
 
 class OrgEvent(org.OrgEntry):
-    """Documentation for OrgEntry"""
+    """Org entry of an event record
+
+    Only the start and duration are resolved up front, the heading,
+    description and properties are read from the record when rendered."""
+
+    __slots__ = ("dtstart", "duration", "dates")
+    property_parser = staticmethod(get_properties)
 
     def __init__(self, event):
         super().__init__(event)
-        self.property_parser = get_properties
-        self.heading = event["SUMMARY"]
-        self.dtstart = put_tz(event["DTSTART"].dt)
+        self.dtstart = put_tz(event["DTSTART"])
         if "DTEND" in event:
-            self.dtend = put_tz(event["DTEND"].dt)
-            self.duration = self.dtend - self.dtstart
+            self.duration = put_tz(event["DTEND"]) - self.dtstart
         else:
-            self.duration = event["DURATION"].dt
+            self.duration = event["DURATION"]
 
         self.dates = ""
 
-        self.description = (
-            event["DESCRIPTION"].replace(" \n", "\n") if "DESCRIPTION" in event else ""
-        ).replace("*", "-")
+    @property
+    def heading(self):
+        "Heading"
+        return self.entry["SUMMARY"]
+
+    @property
+    def description(self):
+        "Description"
+        return self.entry["DESCRIPTION"].replace(" \n", "\n").replace("*", "-")
 
     @property
     def tags(self):
         "Tags"
 
         _tags = self.entry.get("CATEGORIES", [])
-        if not isinstance(_tags, list):
-            _tags = [_tags]
-
-        _tags = map(
-            lambda x: x.to_ical().decode("utf-8").replace(" ", "-").replace(",", ":"),
-            _tags,
-        )
 
         if "RRULE" in self.entry or "RECURRENCE-ID" in self.entry:
-            _tags = list(_tags) + ["rrule"]
+            _tags = _tags + ["rrule"]
 
         return org.tags(_tags)
 
@@ -150,16 +251,31 @@ class OrgEvent(org.OrgEntry):
 
         if "RRULE" in self.entry:
             rule = rrule(self, exceptions)
-            self.dates = "".join(
-                org_interval(event_start, self.duration, get_localzone())
-                for event_start in rule.between(after=start, before=end)
-            )
+            occurrences = rule.between(after=start, before=end)
+            STATS.count("occurrences_expanded", len(occurrences))
+            self.dates = local_stamps().intervals(occurrences, self.duration)
 
         elif self.dtstart < end and self.dtstart > start:
-            self.dates = org_interval(self.dtstart, self.duration, get_localzone())
+            STATS.count("occurrences_expanded")
+            self.dates = local_stamps().intervals([self.dtstart], self.duration)
 
         return self.dates
 
+    def bounds(self, start, end):
+        """First occurrence after START and first one from END on
+
+        None where there is no such occurrence. The visible occurrences
+        only change once the window moves past these bounds."""
+
+        if "RRULE" in self.entry:
+            rule = rrule(self)
+            return rule.after(start), rule.after(end, inc=True)
+
+        return (
+            self.dtstart if self.dtstart > start else None,
+            self.dtstart if self.dtstart >= end else None,
+        )
+
 
 def changev(evlist, start, end):
     "Clean repeating occurrences that have a specific event change"
@@ -177,24 +293,306 @@ def changev(evlist, start, end):
     return ([base] if base.dates else []) + evlist
 
 
-def org_calendar(ical, start, end):
-    "Return calendar time relevant calendar events"
-    events = (OrgEvent(entry) for entry in ical.walk() if entry.name == "VEVENT")
-    regular_events = {}
-    for event in events:
-        if event.date_block(start, end):
-            regular_events.setdefault(event.entry.get("UID"), []).append(event)
+def calendar_events(ical):
+    "Records of all the events of the parsed icalendar ICAL"
+    return [event_record(entry) for entry in ical.walk() if entry.name == "VEVENT"]
+
 
-    for evlist in regular_events.values():
-        yield from map(str, changev(evlist, start, end))
+def render(records, start, end):
+    """Org entries of the event RECORDS sharing a UID
 
+    Returns the entries and the events."""
+    with STATS.stage("expand"):
+        events = list(map(OrgEvent, records))
+        shown = [event for event in events if event.date_block(start, end)]
+        changed = changev(shown, start, end)
+    with STATS.stage("render"):
+        entries = list(map(str, changed))
 
-def org_events(calendars, ahead, back):
-    "Iterator of all events in calendars from [today-back;today+ahead]"
+    return entries, events
+
+
+def bounds(events, start, end):
+    "Bounds of the moving window for which the rendered EVENTS stay valid"
+    lower, upper = zip(*(event.bounds(start, end) for event in events))
+    return (
+        min(filter(None, lower), default=None),
+        min(filter(None, upper), default=None),
+    )
 
+
+def group_entries(records, start, end, renders=None):
+    """Org entries of the event RECORDS sharing a UID
+
+    None are rendered without any candidate record in the window, with a
+    RENDERS cache only when the records or visible occurrences changed."""
+    if not any(candidate(record, start, end) for record in records):
+        STATS.count("events_skipped", len(records))
+        return []
+    if renders is None:
+        return render(records, start, end)[0]
+    if (entries := renders.get(records, start, end)) is not None:
+        STATS.count("render_cache_hits")
+        return entries
+
+    STATS.count("render_cache_misses")
+    entries, rendered = render(records, start, end)
+    renders.put(records, start, end, entries, *bounds(rendered, start, end))
+    return entries
+
+
+def org_calendar(events, start, end, renders=None):
+    """Return calendar time relevant calendar events
+
+    Events stream through one by one, only the records of UIDs with changed
+    occurrences are kept until the last of them to render them together
+    through changev. RENDERS is the optional cache of group_entries."""
+    last = {}
+    changed = {event.get("UID") for event in events if "RECURRENCE-ID" in event}
+    for index, event in enumerate(events):
+        if (uid := event.get("UID")) in changed:
+            last[uid] = index
+
+    pending = {}
+    for index, event in enumerate(events):
+        if (uid := event.get("UID")) not in last:
+            yield from group_entries((event,), start, end, renders)
+        elif index < last[uid]:
+            pending.setdefault(uid, []).append(event)
+        else:
+            records = (*pending.pop(uid, ()), event)
+            yield from group_entries(records, start, end, renders)
+
+
+def parse(text):
+    "Event records of the icalendar TEXT, str or bytes"
+    from icalendar import Calendar  # type: ignore
+
+    with STATS.stage("parse"):
+        events = calendar_events(Calendar.from_ical(text))
+    STATS.count("events_parsed", len(events))
+    return events
+
+
+def read_calendar(text, cache_dir=None):
+    """Event records of the icalendar TEXT, str or downloaded bytes
+
+    With a CACHE_DIR the records are stored keyed by the content of the
+    calendar and unchanged calendars are not parsed again."""
+    if cache_dir is None:
+        return parse(text)
+
+    path = cache.events_path(cache_dir, text)
+    if (events := cache.load_events(path)) is None:
+        STATS.count("parse_cache_misses")
+        events = parse(text)
+        cache.dump_events(path, events)
+    else:
+        STATS.count("parse_cache_hits")
+    return events
+
+
+def modified(record):
+    "Epoch seconds of the LAST-MODIFIED of the event RECORD, -inf without it"
+    if (value := record.get("LAST-MODIFIED")) is None:
+        return float("-inf")
+    return moment(value).timestamp()
+
+
+POLICIES = {
+    "first": lambda record: 0,
+    "sequence": lambda record: (record.get("SEQUENCE", 0), modified(record)),
+    "last-modified": lambda record: (modified(record), record.get("SEQUENCE", 0)),
+}
+
+
+def unique_events(calendars, policy="sequence"):
+    """Event records of each of CALENDARS without the copies in the others
+
+    Records sharing UID and RECURRENCE-ID are copies of one event, the one
+    ranking highest by POLICY is kept, the first one on ties. The kept
+    records of a UID all go to the first calendar having it, so that changed
+    occurrences are rendered together with their repeating event."""
+    if (rank := POLICIES.get(policy)) is None:
+        raise ValueError(f"Unknown duplicates policy: {policy}")
+
+    home = {}
+    newest = {}
+    for index, records in enumerate(calendars):
+        for record in records:
+            if uid := record.get("UID"):
+                home.setdefault(uid, index)
+                key = uid, record.get("RECURRENCE-ID")
+                if key not in newest or rank(record) > rank(newest[key]):
+                    newest[key] = record
+
+    kept = [[] for _ in calendars]
+    for index, records in enumerate(calendars):
+        for record in records:
+            if not (uid := record.get("UID")):
+                kept[index].append(record)
+            elif newest[uid, record.get("RECURRENCE-ID")] is record:
+                kept[home[uid]].append(record)
+    STATS.count("duplicates_dropped", sum(map(len, calendars)) - sum(map(len, kept)))
+    return kept
+
+
+class EventStream:
+    """Render the events of an icalendar text fed line by line
+
+    Every VEVENT is parsed on its own as soon as it is complete, together
+    with the VTIMEZONEs seen before it. Single events are rendered right away,
+    repeating events and their changed occurrences are kept by UID until the
+    end of the calendar. Events whose UID and RECURRENCE-ID are in the SEEN
+    set, shared by the streams of other calendars, are skipped as copies."""
+
+    def __init__(self, start, end, seen=None):
+        self.start = start
+        self.end = end
+        self.seen = set() if seen is None else seen
+        self.timezones = []
+        self.block = []
+        self.depth = 0
+        self.recurring = {}
+
+    def feed(self, line):
+        "Take the next LINE of the calendar, iterate the entries it completes"
+        if not self.block and not line.startswith(("BEGIN:VEVENT", "BEGIN:VTIMEZONE")):
+            return
+
+        self.block.append(line)
+        if line.startswith("BEGIN:"):
+            self.depth += 1
+        elif line.startswith("END:"):
+            self.depth -= 1
+        if self.depth:
+            return
+
+        block, self.block = self.block, []
+        if block[0].startswith("BEGIN:VTIMEZONE"):
+            self.timezones.extend(block)
+        else:
+            for record in parse(
+                "\n".join(["BEGIN:VCALENDAR", *self.timezones, *block, "END:VCALENDAR"])
+            ):
+                if uid := record.get("UID"):
+                    if (key := (uid, record.get("RECURRENCE-ID"))) in self.seen:
+                        STATS.count("duplicates_dropped")
+                        continue
+                    self.seen.add(key)
+                if "RRULE" in record or "RECURRENCE-ID" in record:
+                    self.recurring.setdefault(record.get("UID"), []).append(record)
+                else:
+                    yield from group_entries([record], self.start, self.end)
+
+    def close(self):
+        "Iterate the entries of the repeating events"
+        for records in self.recurring.values():
+            yield from group_entries(records, self.start, self.end)
+        self.recurring = {}
+
+
+def window(ahead, back):
+    "UTC time window [now-back;now+ahead]"
     now = datetime.now(utc)
-    start = now - timedelta(back)
-    end = now + timedelta(ahead)
+    return now - timedelta(back), now + timedelta(ahead)
+
+
+@lru_cache(maxsize=None)
+def worker_renders(cache_dir):
+    "Render cache of a worker process, loaded once"
+    return cache.RenderCache(cache_dir) if cache_dir is not None else None
 
-    for ical in map(Calendar.from_ical, calendars):
-        yield from org_calendar(ical, start, end)
+
+def calendar_records(calendar, cache_dir=None):
+    "Event records of CALENDAR, parsed in a worker, and the measurements"
+    return read_calendar(calendar, cache_dir), STATS.handoff()
+
+
+def calendar_entries(records, start, end, cache_dir=None):
+    """Org entries of the event RECORDS, rendered in a worker process
+
+    Returns the entries, the render cache entries used for them and the
+    measurements of the work, see Stats.handoff."""
+    renders = worker_renders(cache_dir)
+    entries = list(org_calendar(records, start, end, renders))
+    if renders is None:
+        return entries, {}, STATS.handoff()
+
+    used, renders.used = renders.used, {}
+    renders.entries.update(used)
+    return entries, used, STATS.handoff()
+
+
+class CalendarPool:
+    """Calendars parsed and rendered by a pool of JOBS workers
+
+    Calendars are parsed as soon as they are given, a thread for one JOBS or a
+    pool of processes for more. Once all are parsed, copies of events across
+    them are dropped following the duplicates POLICY and they are rendered,
+    with the parsed and render caches in CACHE_DIR if given. The caches keep
+    only the calendars and events of this run."""
+
+    def __init__(self, start, end, cache_dir=None, jobs=1, policy="sequence"):
+        self.start = start
+        self.end = end
+        self.cache_dir = cache_dir
+        self.policy = policy
+        self.paths = set()
+        if jobs > 1:
+            self.executor = ProcessPoolExecutor(jobs, initializer=reset_worker)
+        else:
+            self.executor = ThreadPoolExecutor(1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        self.executor.shutdown()
+
+    def parse(self, calendar):
+        "Future of the calendar_records of CALENDAR"
+        if self.cache_dir is not None:
+            self.paths.add(cache.events_path(self.cache_dir, calendar))
+        return self.executor.submit(calendar_records, calendar, self.cache_dir)
+
+    def entries(self, parsed):
+        """Iterate the org entries of the PARSED calendar_records results
+
+        The entries keep the order of the calendars."""
+        calendars = []
+        for records, measured in parsed:
+            STATS.merge(measured)
+            calendars.append(records)
+
+        renders = None
+        if self.cache_dir is not None:
+            renders = cache.RenderCache(self.cache_dir)
+        for entries, used, measured in self.executor.map(
+            calendar_entries,
+            unique_events(calendars, self.policy),
+            repeat(self.start),
+            repeat(self.end),
+            repeat(self.cache_dir),
+        ):
+            if renders is not None:
+                renders.used.update(used)
+            STATS.merge(measured)
+            yield from entries
+
+        if renders is not None:
+            renders.save()
+            cache.prune_events(self.cache_dir, self.paths)
+
+
+def org_events(calendars, ahead, back, cache_dir=None, jobs=1, policy="sequence"):
+    """Iterator of all events in calendars from [today-back;today+ahead]
+
+    Copies of an event in several calendars are rendered once, chosen by the
+    duplicates POLICY. With more than one JOBS the calendars are parsed and
+    rendered in a pool of processes, the entries keep the order of the
+    calendars."""
+    start, end = window(ahead, back)
+    with CalendarPool(start, end, cache_dir, jobs, policy) as pool:
+        parsed = [pool.parse(calendar) for calendar in calendars]
+        yield from pool.entries(future.result() for future in parsed)
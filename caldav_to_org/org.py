@@ -24,20 +24,29 @@ def string(node):
     ).strip()
 
 
+def property_box(properties):
+    "Property drawer of the (name, value) PROPERTIES, empty without any"
+    props = "\n".join(":%s: %s" % (k, v) for k, v in properties)
+    return f""":PROPERTIES:\n{props}\n:END:\n""" if props else ""
+
+
 class OrgEntry:
     "Org-Mode basic entry"
 
+    __slots__ = ("entry",)
+
     def __init__(self, entry):
         self.entry = entry
-        self.property_parser = lambda x: []
+
+    @staticmethod
+    def property_parser(entry):
+        "Properties of ENTRY"
+        return []
 
     @property
     def properties(self):
         "Property box"
-        props = "\n".join(
-            ":%s: %s" % (k, v) for k, v in self.property_parser(self.entry)
-        )
-        return f""":PROPERTIES:\n{props}\n:END:\n""" if props else ""
+        return property_box(self.property_parser(self.entry))
 
     def __str__(self):
         return string(self)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+r"""
+Expand repetition rules
+=======================
+
+The common repetition rules, a FREQ with an INTERVAL and for weekly rules
+plain BYDAY weekdays, are expanded directly from the occurrence index. Looking
+for the occurrences inside a time window then costs only the occurrences in
+that window instead of all the ones since DTSTART. Every other rule is left to
+dateutil.
+"""
+# License: GPL-3
+
+from datetime import datetime, time, timedelta, timezone
+
+from dateutil.rrule import rrulestr
+
+WEEKDAYS = ("MO", "TU", "WE", "TH", "FR", "SA", "SU")
+SIMPLE_KEYS = {"FREQ", "INTERVAL", "COUNT", "UNTIL", "BYDAY", "WKST"}
+PERIOD_DAYS = {"DAILY": 1, "WEEKLY": 7, "MONTHLY": 31, "YEARLY": 366}
+
+
+class Recurrence:
+    """Occurrences of a simple repetition rule
+
+    Occurrences are grouped in periods, a day, week, month or year, that are
+    computed from their index. EXDATES is a set of excluded occurrences."""
+
+    def __init__(
+        self,
+        freq,
+        dtstart,
+        interval=1,
+        count=None,
+        until=None,
+        weekdays=None,
+        wkst=0,
+        exdates=(),
+    ):
+        self.freq = freq
+        self.dtstart = dtstart.replace(microsecond=0)
+        self.interval = interval
+        self.count = count
+        self.until = until
+        self.exdates = set(exdates)
+        self.time = time(
+            dtstart.hour, dtstart.minute, dtstart.second, tzinfo=dtstart.tzinfo
+        )
+        self.start = self.dtstart.date()
+
+        if freq == "WEEKLY":
+            weekdays = weekdays or [self.start.weekday()]
+            self.offsets = sorted({(day - wkst) % 7 for day in weekdays})
+            self.week = self.start - timedelta((self.start.weekday() - wkst) % 7)
+            first = (self.start - self.week).days
+            self.first_count = sum(offset >= first for offset in self.offsets)
+
+    def period(self, day):
+        "Index of the period DAY belongs to"
+        if self.freq == "DAILY":
+            return (day - self.start).days // self.interval
+        if self.freq == "WEEKLY":
+            return (day - self.week).days // (7 * self.interval)
+        if self.freq == "MONTHLY":
+            months = (day.year - self.start.year) * 12 + day.month - self.start.month
+            return months // self.interval
+        return (day.year - self.start.year) // self.interval
+
+    def counted(self, period):
+        "Number of occurrences before PERIOD"
+        if self.freq == "WEEKLY" and period > 0:
+            return self.first_count + (period - 1) * len(self.offsets)
+        return period
+
+    def days(self, period):
+        "Days with an occurrence in PERIOD"
+        step = period * self.interval
+        if self.freq == "DAILY":
+            return [self.start + timedelta(step)]
+        if self.freq == "WEEKLY":
+            week = self.week + timedelta(7 * step)
+            return [
+                day
+                for day in (week + timedelta(offset) for offset in self.offsets)
+                if day >= self.start
+            ]
+        if self.freq == "MONTHLY":
+            year, month = divmod(self.start.month - 1 + step, 12)
+            return [self.start.replace(year=self.start.year + year, month=month + 1)]
+        return [self.start.replace(year=self.start.year + step)]
+
+    def occurrences(self, moment):
+        "Iterate the occurrences from about MOMENT on, without the exdates"
+        day = moment.astimezone(self.dtstart.tzinfo).date()
+        period = max(0, self.period(day) - 1)
+        index = self.counted(period)
+        while True:
+            for day in self.days(period):
+                if self.count is not None and index >= self.count:
+                    return
+                occurrence = datetime.combine(day, self.time)
+                if self.until is not None and occurrence > self.until:
+                    return
+                index += 1
+                if occurrence not in self.exdates:
+                    yield occurrence
+            period += 1
+
+    def between(self, after, before, inc=False):
+        "Occurrences between AFTER and BEFORE, including them with INC"
+        found = []
+        for occurrence in self.occurrences(after):
+            if occurrence > before or (occurrence == before and not inc):
+                break
+            if occurrence > after or (occurrence == after and inc):
+                found.append(occurrence)
+        return found
+
+    def after(self, moment, inc=False):
+        "First occurrence after MOMENT, including it with INC"
+        for occurrence in self.occurrences(moment):
+            if occurrence > moment or (occurrence == moment and inc):
+                return occurrence
+        return None
+
+
+def parse_until(value):
+    "UTC datetime of an UNTIL value, None when not in UTC form"
+    try:
+        return datetime.strptime(value, "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+
+def last_start(rule_text, dtstart):
+    """Latest start an occurrence of RULE_TEXT from DTSTART can have
+
+    Taken from the UNTIL of the rule, or from its COUNT when every period has
+    an occurrence. None when the rule has no evident end."""
+    try:
+        parts = dict(part.split("=", 1) for part in rule_text.split(";"))
+    except ValueError:
+        return None
+
+    if "UNTIL" in parts:
+        return parse_until(parts["UNTIL"])
+    freq = parts.get("FREQ")
+    if (
+        "COUNT" not in parts
+        or not parts.keys() <= SIMPLE_KEYS
+        or freq not in PERIOD_DAYS
+        or ("BYDAY" in parts and freq != "WEEKLY")
+        or (freq in ("MONTHLY", "YEARLY") and dtstart.day > 28)
+    ):
+        return None
+
+    periods = int(parts.get("INTERVAL", 1)) * int(parts["COUNT"]) + 1
+    return dtstart + timedelta(PERIOD_DAYS[freq] * periods)
+
+
+def simple_rule(rule_text, dtstart, exdates):
+    "Recurrence of RULE_TEXT, None if it needs the general expansion"
+    try:
+        parts = dict(part.split("=", 1) for part in rule_text.split(";"))
+    except ValueError:
+        return None
+
+    freq = parts.get("FREQ")
+    weekdays = parts.get("BYDAY", "").split(",") if "BYDAY" in parts else None
+    if (
+        not parts.keys() <= SIMPLE_KEYS
+        or freq not in ("DAILY", "WEEKLY", "MONTHLY", "YEARLY")
+        or not isinstance(dtstart, datetime)
+        or dtstart.tzinfo is None
+        or any(day not in WEEKDAYS for day in weekdays or [])
+        or parts.get("WKST", "MO") not in WEEKDAYS
+    ):
+        return None
+
+    interval = int(parts.get("INTERVAL", 1))
+    if weekdays is not None and freq == "DAILY" and interval == 1:
+        freq = "WEEKLY"
+    if weekdays is not None and freq != "WEEKLY":
+        return None
+    # Months or years lacking the day would be skipped
+    if freq in ("MONTHLY", "YEARLY") and dtstart.day > 28:
+        return None
+
+    until = None
+    if "UNTIL" in parts and (until := parse_until(parts["UNTIL"])) is None:
+        return None
+
+    return Recurrence(
+        freq,
+        dtstart,
+        interval=interval,
+        count=int(parts["COUNT"]) if "COUNT" in parts else None,
+        until=until,
+        weekdays=[WEEKDAYS.index(day) for day in weekdays or []],
+        wkst=WEEKDAYS.index(parts.get("WKST", "MO")),
+        exdates=exdates,
+    )
+
+
+def rule(rule_text, dtstart, exdates=()):
+    """Occurrences of the repetition rule RULE_TEXT starting at DTSTART
+
+    The returned rule answers between and after like a dateutil rruleset,
+    without the occurrences in EXDATES."""
+    if (recurrence := simple_rule(rule_text, dtstart, exdates)) is not None:
+        return recurrence
+
+    ruleset = rrulestr(rule_text, dtstart=dtstart, forceset=True)
+    for exdate in exdates:
+        ruleset.exdate(exdate)
+    return ruleset
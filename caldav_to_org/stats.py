@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+r"""
+Stage timings and counters
+==========================
+
+Wall time of every stage of a run, overall and by resource url, and counters
+of the work done. Disabled, the hooks return at once.
+"""
+# License: GPL-3
+
+import json
+import sys
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+
+NULL = nullcontext()
+
+
+class Stats:
+    "Wall time by stage and url, and counters of a run"
+
+    def __init__(self):
+        self.enabled = False
+        self.worker = False
+        self.reset()
+
+    def reset(self):
+        "Forget all measurements"
+        self.stages = defaultdict(float)
+        self.urls = defaultdict(lambda: defaultdict(float))
+        self.counters = Counter()
+
+    def stage(self, name, url=None):
+        "Context timing the stage NAME, also by URL if given"
+        if not self.enabled:
+            return NULL
+        return self.timed(name, url)
+
+    @contextmanager
+    def timed(self, name, url):
+        "Add the wall time of the context to stage NAME"
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stages[name] += elapsed
+            if url is not None:
+                self.urls[url][name] += elapsed
+
+    def count(self, name, amount=1):
+        "Add AMOUNT to the counter NAME"
+        if self.enabled:
+            self.counters[name] += amount
+
+    def take(self):
+        "Measurements so far as plain data, forgetting them"
+        data = {
+            "stages": dict(self.stages),
+            "urls": {url: dict(stages) for url, stages in self.urls.items()},
+            "counters": dict(self.counters),
+        }
+        self.reset()
+        return data
+
+    def handoff(self):
+        "Measurements of a worker process taken for its parent, None elsewhere"
+        return self.take() if self.worker else None
+
+    def merge(self, data):
+        "Add the measurements DATA taken elsewhere, like in a worker process"
+        if data is None:
+            return
+        for name, seconds in data["stages"].items():
+            self.stages[name] += seconds
+        for url, stages in data["urls"].items():
+            for name, seconds in stages.items():
+                self.urls[url][name] += seconds
+        self.counters.update(data["counters"])
+
+    def report(self, destination="-"):
+        "Write the measurements as JSON to the DESTINATION file, - for stderr"
+        data = self.take()
+        if destination != "-":
+            with open(destination, "w") as fid:
+                json.dump(data, fid, indent=2)
+            return
+
+        for name, seconds in sorted(data["stages"].items()):
+            print(f"{name:<20}{seconds:>10.3f} s", file=sys.stderr)
+        for url, stages in sorted(data["urls"].items()):
+            times = ", ".join(f"{name} {sec:.3f} s" for name, sec in stages.items())
+            print(f"  {url}: {times}", file=sys.stderr)
+        for name, amount in sorted(data["counters"].items()):
+            print(f"{name:<20}{amount:>10}", file=sys.stderr)
+
+
+STATS = Stats()
+
+
+def reset_worker():
+    "Start the measurements of a worker process from scratch, see handoff"
+    STATS.worker = True
+    STATS.reset()
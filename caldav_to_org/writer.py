@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+r"""
+Write org files only when they change
+=====================================
+
+Entries are streamed to a temporary file next to the target, skipping the
+ones already written by their hash. The target is replaced atomically when
+the content differs, and left untouched otherwise so that Emacs does not
+revert an unchanged agenda.
+"""
+# License: GPL-3
+
+import hashlib
+import logging
+import os
+import shutil
+
+from caldav_to_org.stats import STATS
+
+LOGGER = logging.getLogger("Org_calendar")
+
+
+def file_digest(path, size=2 ** 16):
+    "SHA1 digest of the file at PATH, None if it does not exist"
+    digest = hashlib.sha1()
+    try:
+        with open(path, "rb") as fid:
+            while chunk := fid.read(size):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return None
+    return digest.digest()
+
+
+class OrgWriter:
+    """Context writing distinct org entries to PATH, separated by blank lines
+
+    PATH is replaced on exit only if the new content differs, and an error
+    inside the context leaves it untouched."""
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp = f"{path}.tmp"
+        self.seen = set()
+        self.digest = hashlib.sha1()
+        self.changed = False
+        self.fid = None
+
+    @property
+    def entries(self):
+        "Number of distinct entries written"
+        return len(self.seen)
+
+    def __enter__(self):
+        self.fid = open(self.tmp, "wb")
+        return self
+
+    def write(self, entry):
+        "Write ENTRY unless an identical one was already written"
+        text = entry.encode("UTF-8")
+        if (key := hashlib.sha1(text).digest()) in self.seen:
+            return
+        if self.seen:
+            text = b"\n\n" + text
+        self.seen.add(key)
+        self.fid.write(text)
+        self.digest.update(text)
+
+    def __exit__(self, kind, error, traceback):
+        if kind is not None:
+            self.fid.close()
+            os.remove(self.tmp)
+            return
+
+        with STATS.stage("write"):
+            self.fid.write(b"\n")
+            self.digest.update(b"\n")
+            self.fid.close()
+            if file_digest(self.path) == self.digest.digest():
+                LOGGER.info("Unchanged: %s", self.path)
+                os.remove(self.tmp)
+                return
+
+            if os.path.exists(self.path):
+                shutil.copymode(self.path, self.tmp)
+            os.replace(self.tmp, self.path)
+            self.changed = True
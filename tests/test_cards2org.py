@@ -0,0 +1,109 @@
+import os
+import random
+import sys
+
+import pytest
+import vobject
+
+from caldav_to_org import cards2org
+from caldav_to_org.cards2org import OrgContact, org_contacts
+
+BENCHMARKS = os.path.join(os.path.dirname(os.path.dirname(__file__)), "benchmarks")
+sys.path.insert(0, BENCHMARKS)
+import generate  # noqa: E402
+
+TEXTS = [
+    "Ada",
+    "Doe\\, John",
+    "a,b",
+    "x\\ny",
+    "back\\\\slash",
+    "semi\\;colon",
+    "",
+    "ü",
+]
+PROPERTIES = [
+    "N:{0};{1};;;",
+    "N:{0}",
+    "ADR;TYPE=HOME:;;{0};{1};;1010;Austria",
+    "ORG:{0};{1}",
+    "TEL;type=cell;TYPE=pref:+43 {0}",
+    "TEL;CELL:{0}",
+    "TEL;TYPE=:{0}",
+    "item1.EMAIL;TYPE=INTERNET,,WORK:{0}@example.com",
+    "X-ABUID:{0}",
+    "x_custom:{0}",
+    "NOTE:{0}",
+    "CATEGORIES:{0},{1}",
+    "GEO:{0};{1}",
+    "URL:http://example.com/{0}",
+    "TITLE:{0}",
+    "UID:{0}",
+    "REV:2019-05-01T10:00:00Z",
+    "REV:20190501T100000Z",
+    "REV:2019-05-01",
+    "REV:2019-05-01T10:00:00.5+02:00",
+    "REV:May 1 2019 10:00",
+    "NICKNAME;ENCODING=QUOTED-PRINTABLE:{0}",
+    'TEL;TYPE="work,voice":{0}',
+    "LABEL;TYPE=HOME:{0}\\n{1}",
+]
+
+
+def random_card(rand, index):
+    "vCard text with random properties and folded lines"
+    lines = ["BEGIN:VCARD"]
+    if rand.random() < 0.9:
+        lines.append(f"VERSION:{rand.choice(['3.0', '4.0', '2.1'])}")
+    lines.append(f"FN:{rand.choice(TEXTS)} {index}")
+    for _ in range(rand.randint(0, 8)):
+        line = rand.choice(PROPERTIES).format(rand.choice(TEXTS), rand.choice(TEXTS))
+        if len(line) > 10 and rand.random() < 0.2:
+            cut = rand.randint(1, len(line) - 1)
+            line = line[:cut] + "\r\n" + rand.choice(" \t") + line[cut:]
+        lines.append(line)
+    lines.append("END:VCARD")
+    return "\r\n".join(lines)
+
+
+def vobject_contacts(book):
+    "Entries rendered by vobject alone"
+    return [str(OrgContact(contact)) for contact in vobject.readComponents(book)]
+
+
+def outcome(function, book):
+    "Entries of FUNCTION for BOOK, or the type of the error it raised"
+    try:
+        return list(function(book))
+    except Exception as error:  # pylint: disable=broad-except
+        return type(error)
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_same_as_vobject(seed):
+    rand = random.Random(seed)
+    book = "\r\n".join(random_card(rand, index) for index in range(3)) + "\r\n"
+    fast = outcome(lambda text: org_contacts([text]), book)
+    assert fast == outcome(vobject_contacts, book)
+
+
+def test_generated_address_book_takes_the_fast_path():
+    book = generate.addressbook(200)
+    cards = cards2org.vcards(book)
+    assert all(cards2org.fast_contact(lines) is not None for lines in cards)
+    assert list(org_contacts([book])) == vobject_contacts(book)
+
+
+def test_parallel_jobs_keep_the_order(monkeypatch):
+    monkeypatch.setattr(cards2org, "BATCH", 10)
+    book = generate.addressbook(45)
+    assert list(org_contacts([book], jobs=2)) == vobject_contacts(book)
+
+
+def test_irregular_books_use_vobject():
+    agent = (
+        "BEGIN:VCARD\nVERSION:3.0\nFN:Boss\nBEGIN:VCARD\nFN:Agent\nEND:VCARD\n"
+        "END:VCARD\n"
+    )
+    assert cards2org.vcards(agent) is None
+    assert outcome(org_contacts, [agent]) == outcome(vobject_contacts, agent)
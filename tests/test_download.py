@@ -0,0 +1,753 @@
+import argparse
+import asyncio
+import configparser
+import os
+import re
+import time
+
+import aiohttp
+import pytest
+from aiohttp import web
+from icalendar import Calendar
+
+import caldav_to_org
+from caldav_to_org import cards2org, ical2org
+from caldav_to_org.stats import STATS
+
+CALENDAR = """BEGIN:VCALENDAR
+BEGIN:VEVENT
+UID:first
+SUMMARY:Feed the dragons
+DTSTART:20200319T103000Z
+DTEND:20200319T113000Z
+END:VEVENT
+END:VCALENDAR"""
+BODY = CALENDAR.encode()
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    """Keep cache files in a temporary directory and skip the passwordstore"""
+
+    async def password(address, ttl=None):
+        return "secret"
+
+    monkeypatch.setattr(caldav_to_org, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(caldav_to_org, "passwordstore", password)
+    return tmp_path
+
+
+def calendar_app(requests):
+    "Server answering with an ETag and honouring If-None-Match"
+
+    async def calendar(request):
+        requests.append(dict(request.headers))
+        if request.headers.get("If-None-Match") == '"v1"':
+            return web.Response(status=304)
+        return web.Response(text=CALENDAR, headers={"ETag": '"v1"'})
+
+    app = web.Application()
+    app.router.add_get("/cal", calendar)
+    return app
+
+
+def serve(app, fetcher):
+    "Run FETCHER against the url of APP"
+
+    async def run():
+        server = web.AppRunner(app)
+        await server.setup()
+        site = web.TCPSite(server, "127.0.0.1", 0)
+        await site.start()
+        port = server.addresses[0][1]
+        try:
+            async with aiohttp.ClientSession() as session:
+                return await fetcher(f"http://127.0.0.1:{port}/cal", session)
+        finally:
+            await server.cleanup()
+
+    return asyncio.run(run())
+
+
+def fetch(app, **kwargs):
+    "Download the calendar of APP twice"
+    section = {"user": "me", "passwordstore": "cal"}
+
+    async def twice(url, session):
+        return [
+            await caldav_to_org.download(url, section, session=session, **kwargs)
+            for _ in range(2)
+        ]
+
+    return serve(app, twice)
+
+
+def test_revalidation(cache):
+    requests = []
+    assert fetch(calendar_app(requests), force=False) == [BODY, BODY]
+    assert "If-None-Match" not in requests[0]
+    assert requests[1]["If-None-Match"] == '"v1"'
+
+
+def test_body_is_kept_as_bytes(cache):
+    body = CALENDAR.replace("dragons", "Drachen für Jürgen").encode()
+
+    async def calendar(request):
+        return web.Response(body=body, content_type="text/calendar")
+
+    app = web.Application()
+    app.router.add_get("/cal", calendar)
+    assert fetch(app, force=False) == [body, body]
+    (event,) = ical2org.parse(body)
+    assert event["SUMMARY"] == "Feed the Drachen für Jürgen"
+
+
+def test_force_ignores_validators(cache):
+    requests = []
+    assert fetch(calendar_app(requests), force=True) == [BODY, BODY]
+    assert all("If-None-Match" not in headers for headers in requests)
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_unreadable_cache_is_fetched_again(cache, stream):
+    requests = []
+    section = {"user": "me", "passwordstore": "cal"}
+
+    async def get(url, session):
+        if stream:
+            lines = caldav_to_org.stream_lines(url, section, False, session)
+            return "\n".join([line async for line in lines]) + "\n"
+        return (await caldav_to_org.download(url, section, False, session)).decode()
+
+    async def corrupt(url, session):
+        await get(url, session)
+        with open(caldav_to_org.download_cache().path(url), "r+b") as fid:
+            fid.seek(-8, os.SEEK_END)
+            fid.write(b"garbage!")
+        return await get(url, session)
+
+    assert serve(calendar_app(requests), corrupt).rstrip() == CALENDAR.rstrip()
+    assert all("If-None-Match" not in headers for headers in requests)
+    assert len(requests) == 2
+
+
+def test_stream_calendar(cache):
+    daily = CALENDAR.replace("END:VEVENT", "RRULE:FREQ=DAILY\nEND:VEVENT")
+
+    async def calendar(request):
+        return web.Response(text=daily)
+
+    app = web.Application()
+    app.router.add_get("/cal", calendar)
+    config = configparser.ConfigParser()
+    config.read_dict({"cal": {"user": "me", "passwordstore": "cal"}})
+
+    async def stream(url, session):
+        entries = [
+            entry
+            async for entry in caldav_to_org.stream_calendar(
+                url, config["cal"], False, session
+            )
+        ]
+        return entries, caldav_to_org.download_cache().get(url)
+
+    (entry,), cached = serve(app, stream)
+    assert entry.startswith("* Feed the dragons  :rrule:")
+    assert entry.count("<") == 2 * (50 + 14)
+    assert cached == daily
+
+
+def test_shared_password_lookup(monkeypatch):
+    lookups = []
+
+    async def pass_show(address):
+        lookups.append(address)
+        await asyncio.sleep(0.01)
+        caldav_to_org.SECRETS[address] = 0, f"secret of {address}"
+        return f"secret of {address}"
+
+    monkeypatch.setattr(caldav_to_org, "pass_show", pass_show)
+    monkeypatch.setattr(caldav_to_org, "SECRETS", {})
+
+    async def lookup(*addresses, ttl=None):
+        return await asyncio.gather(
+            *(caldav_to_org.passwordstore(address, ttl) for address in addresses)
+        )
+
+    assert asyncio.run(lookup("cal", "cal", "book", "cal")) == [
+        "secret of cal",
+        "secret of cal",
+        "secret of book",
+        "secret of cal",
+    ]
+    assert lookups == ["cal", "book"]
+    asyncio.run(lookup("cal", "book"))
+    assert lookups == ["cal", "book"]
+    # Expired secrets are looked up again
+    asyncio.run(lookup("cal", ttl=1))
+    assert lookups == ["cal", "book", "cal"]
+
+
+def flaky_app(failures, status=503):
+    "Server failing with STATUS for the first FAILURES requests"
+    requests = []
+
+    async def calendar(request):
+        requests.append(request)
+        if len(requests) <= failures:
+            return web.Response(status=status)
+        return web.Response(text=CALENDAR)
+
+    app = web.Application()
+    app.router.add_get("/cal", calendar)
+    return app, requests
+
+
+def resource_config(url, **options):
+    "Config with a single calendar at URL"
+    config = configparser.ConfigParser()
+    config.read_dict(
+        {
+            "DEFAULT": {"backoff": "0", **options},
+            "server": {
+                "url": url.replace("/cal", "/{}"),
+                "calendars": "cal",
+                "user": "me",
+                "passwordstore": "cal",
+            },
+        }
+    )
+    return config
+
+
+def test_retries_server_errors(cache):
+    app, requests = flaky_app(2)
+
+    async def resources(url, session):
+        config = resource_config(url)
+        return await caldav_to_org.get_resource(config, "calendars", True)
+
+    assert serve(app, resources) == [BODY]
+    assert len(requests) == 3
+
+
+def test_stale_copy_on_failure(cache):
+    app, requests = flaky_app(10, status=500)
+
+    async def resources(url, session):
+        config = resource_config(url, retries="1")
+        return await caldav_to_org.get_resource(config, "calendars", True)
+
+    async def stale_resources(url, session):
+        caldav_to_org.download_cache().put(url, "stale")
+        return await resources(url, session)
+
+    assert serve(app, stale_resources) == [b"stale"]
+    assert len(requests) == 2
+
+    async def uncached_resources(url, session):
+        caldav_to_org.download_cache().remove(url)
+        return await resources(url, session)
+
+    app, requests = flaky_app(10, status=500)
+    assert serve(app, uncached_resources) == []
+
+
+def test_stale_copy_on_malformed_multistatus(cache):
+    async def report(request):
+        return web.Response(status=207, text="<D:multistatus")
+
+    app = web.Application()
+    app.router.add_route("REPORT", "/cal", report)
+
+    async def resources(url, session):
+        caldav_to_org.download_cache().put(url, "stale")
+        config = resource_config(url, timerange="yes")
+        return await caldav_to_org.get_resource(config, "calendars", True)
+
+    assert serve(app, resources) == [b"stale"]
+
+
+def test_retry_after_is_capped():
+    reply = argparse.Namespace(headers={"Retry-After": "86400"})
+    assert caldav_to_org.retry_delay(0, {}, reply) == 300
+    assert caldav_to_org.retry_delay(0, {"max_delay": "5"}, reply) == 5
+    reply.headers["Retry-After"] = "2"
+    assert caldav_to_org.retry_delay(0, {}, reply) == 2
+    assert caldav_to_org.retry_delay(20, {"max_delay": "5"}) <= 5
+
+
+def test_cache_ttl_skips_the_server(cache):
+    requests = []
+    section = {"user": "me", "passwordstore": "cal", "cache_ttl": "600"}
+
+    async def twice(url, session):
+        return [
+            await caldav_to_org.download(url, section, False, session)
+            for _ in range(2)
+        ]
+
+    assert serve(calendar_app(requests), twice) == [BODY, BODY]
+    assert len(requests) == 1
+
+
+def test_offline_uses_cache(cache):
+    requests = []
+    assert fetch(calendar_app(requests), force=False, offline=True) == [BODY, BODY]
+    assert len(requests) == 1
+
+
+MULTISTATUS = """<?xml version="1.0" encoding="utf-8"?>
+<D:multistatus xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav">
+  <D:response>
+    <D:href>/cal/first.ics</D:href>
+    <D:propstat>
+      <D:prop><C:calendar-data>BEGIN:VCALENDAR
+BEGIN:VEVENT
+UID:first
+SUMMARY:Feed the dragons
+DTSTART:20200319T103000Z
+DTEND:20200319T113000Z
+END:VEVENT
+END:VCALENDAR</C:calendar-data></D:prop>
+      <D:status>HTTP/1.1 200 OK</D:status>
+    </D:propstat>
+  </D:response>
+  <D:response>
+    <D:href>/cal/second.ics</D:href>
+    <D:propstat>
+      <D:prop><C:calendar-data>BEGIN:VCALENDAR
+BEGIN:VEVENT
+UID:second
+SUMMARY:Go hunting
+DTSTART:20200320T103000Z
+DTEND:20200320T113000Z
+END:VEVENT
+END:VCALENDAR</C:calendar-data></D:prop>
+      <D:status>HTTP/1.1 200 OK</D:status>
+    </D:propstat>
+  </D:response>
+</D:multistatus>"""
+
+
+def test_time_range_query(cache):
+    bodies = []
+
+    async def report(request):
+        bodies.append(await request.text())
+        return web.Response(status=207, text=MULTISTATUS)
+
+    app = web.Application()
+    app.router.add_route("REPORT", "/cal", report)
+    config = configparser.ConfigParser()
+    config.read_dict(
+        {
+            "DEFAULT": {"ahead": "10", "back": "5"},
+            "cal": {"user": "me", "passwordstore": "cal", "cache_ttl": "600"},
+        }
+    )
+
+    async def query(url, session):
+        return [
+            await caldav_to_org.query(url, config["cal"], force, session)
+            for force in (False, False, True)
+        ]
+
+    calendar, cached, forced = serve(app, query)
+    assert calendar == cached == forced
+    # Only a forced query skips the fresh cached result
+    assert len(bodies) == 2
+    assert "<C:time-range start=" in bodies[0]
+    assert calendar.count("BEGIN:VEVENT") == 2
+    assert calendar.startswith("BEGIN:VCALENDAR")
+    assert calendar.endswith("END:VCALENDAR")
+    assert uids(calendar) == ["first", "second"]
+
+
+def uids(ical):
+    "UIDs of the events in ICAL"
+    return [event["UID"] for event in Calendar.from_ical(ical).walk("VEVENT")]
+
+
+def resource(uid):
+    "Calendar resource holding a single event"
+    return f"""BEGIN:VCALENDAR
+BEGIN:VEVENT
+UID:{uid}
+SUMMARY:{uid}
+DTSTART:20200319T103000Z
+DTEND:20200319T113000Z
+END:VEVENT
+END:VCALENDAR"""
+
+
+def multistatus(token, *responses):
+    "Sync-collection reply"
+    body = "".join(responses)
+    return f"""<?xml version="1.0" encoding="utf-8"?>
+<D:multistatus xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav">
+{body}<D:sync-token>{token}</D:sync-token></D:multistatus>"""
+
+
+def found(href, data=None):
+    "Response of a changed resource, with or without its calendar data"
+    data = f"<C:calendar-data>{data}</C:calendar-data>" if data else ""
+    return f"""<D:response><D:href>{href}</D:href><D:propstat>
+<D:prop><D:getetag>"1"</D:getetag>{data}</D:prop>
+<D:status>HTTP/1.1 200 OK</D:status></D:propstat></D:response>"""
+
+
+def gone(href):
+    "Response of a deleted resource"
+    return f"""<D:response><D:href>{href}</D:href>
+<D:status>HTTP/1.1 404 Not Found</D:status></D:response>"""
+
+
+def test_sync_collection(cache):
+    bodies = []
+
+    async def report(request):
+        body = await request.text()
+        bodies.append(body)
+        if "calendar-multiget" in body:
+            return web.Response(
+                status=207, text=multistatus("", found("/c", resource("c")))
+            )
+        if "<D:sync-token></D:sync-token>" in body:
+            return web.Response(
+                status=207,
+                text=multistatus(
+                    "t1", found("/a", resource("a")), found("/b", resource("b"))
+                ),
+            )
+        if "<D:sync-token>t1</D:sync-token>" in body:
+            # Event data mentioning the precondition does not expire the token
+            changed = resource("b").replace("SUMMARY:b", "SUMMARY:valid-sync-token")
+            return web.Response(
+                status=207,
+                text=multistatus("t2", gone("/a"), found("/b", changed), found("/c")),
+            )
+        return web.Response(
+            status=403, text='<D:error xmlns:D="DAV:"><D:valid-sync-token/></D:error>'
+        )
+
+    app = web.Application()
+    app.router.add_route("REPORT", "/cal", report)
+    section = {"user": "me", "passwordstore": "cal"}
+
+    async def three_syncs(url, session):
+        return [
+            await caldav_to_org.sync(url, section, False, session) for _ in range(3)
+        ]
+
+    first, second, third = serve(app, three_syncs)
+    assert uids(first) == ["a", "b"]
+    assert uids(second) == ["b", "c"]
+    # the expired token t2 forces a full sync
+    assert uids(third) == ["a", "b"]
+    assert sum("calendar-multiget" in body for body in bodies) == 1
+
+
+def test_daemon_renders_changed_sources(cache, monkeypatch):
+    monkeypatch.setattr(caldav_to_org, "CACHE_DIR", str(cache))
+    versions = [CALENDAR.replace("END:VEVENT", "RRULE:FREQ=DAILY\nEND:VEVENT")]
+    requests, saved = [], []
+
+    async def calendar(request):
+        requests.append(request)
+        return web.Response(text=versions[-1])
+
+    save_agenda = caldav_to_org.save_agenda
+
+    def counted_save(*args):
+        saved.append(save_agenda(*args))
+
+    monkeypatch.setattr(caldav_to_org, "save_agenda", counted_save)
+    app = web.Application()
+    app.router.add_get("/cal", calendar)
+    config_file = cache / "calendars.conf"
+    agenda = cache / "agenda.org"
+    args = argparse.Namespace(contacts=False, force=False, jobs=1)
+
+    async def refreshes(url, session):
+        config_file.write_text(
+            f"[DEFAULT]\nagenda_outfile = {agenda}\n\n[server]\n"
+            f"url = {url.replace('/cal', '/{}')}\ncalendars = cal\n"
+            "user = me\npasswordstore = cal\ninterval = 600\n"
+        )
+        daemon = caldav_to_org.Daemon(str(config_file), args)
+        assert daemon.reload()
+        await daemon.refresh(session)
+        # Not due yet
+        await daemon.refresh(session)
+        assert len(requests) == 1
+        assert daemon.pause() == daemon.config_check
+        daemon.due["server"] = 0
+        await daemon.refresh(session)
+        versions.append(versions[0].replace("Feed the dragons", "Hunt"))
+        daemon.due["server"] = 0
+        await daemon.refresh(session)
+        assert not daemon.reload()
+        os.utime(config_file, (0, 0))
+        assert daemon.reload()
+        # A config saved halfway keeps the previous one
+        config = daemon.config
+        config_file.write_text(config_file.read_text() + "user = again\n")
+        os.utime(config_file, (1, 1))
+        assert not daemon.reload()
+        assert daemon.config is config
+
+    serve(app, refreshes)
+    assert len(requests) == 3
+    assert saved == [True, True]
+    assert agenda.read_text().startswith("* Hunt")
+
+
+def vcard(name):
+    "vCard of the contact NAME"
+    return f"BEGIN:VCARD\nVERSION:3.0\nFN:{name}\nN:{name};;;;\nEND:VCARD\n"
+
+
+def card_listing(*cards):
+    "PROPFIND reply with the href and ETag of the CARDS"
+    body = "".join(
+        f"<D:response><D:href>{href}</D:href><D:propstat><D:prop>"
+        f"<D:getetag>{etag}</D:getetag></D:prop>"
+        "<D:status>HTTP/1.1 200 OK</D:status></D:propstat></D:response>"
+        for href, etag in cards
+    )
+    return f"""<?xml version="1.0" encoding="utf-8"?>
+<D:multistatus xmlns:D="DAV:"><D:response><D:href>/cal/</D:href>
+<D:propstat><D:prop/><D:status>HTTP/1.1 200 OK</D:status></D:propstat>
+</D:response>{body}</D:multistatus>"""
+
+
+def test_declared_charset(cache):
+    daily = CALENDAR.replace("END:VEVENT", "RRULE:FREQ=DAILY\nEND:VEVENT")
+    latin = {
+        "cal": daily.replace("dragons", "Jürgen").encode("latin-1"),
+        "book": vcard("Jürgen").encode("latin-1"),
+    }
+
+    async def resource(request):
+        return web.Response(
+            body=latin[request.match_info["name"]],
+            content_type="text/plain",
+            charset="iso-8859-1",
+        )
+
+    app = web.Application()
+    app.router.add_get("/{name}", resource)
+
+    async def fetch_all(url, session):
+        config = resource_config(url)
+        config["server"]["addressbooks"] = "book"
+        section = config["server"]
+        # Downloaded, then read back from the cache
+        streamed = [
+            [
+                entry
+                async for entry in caldav_to_org.stream_calendar(
+                    url, section, not offline, session, offline
+                )
+            ]
+            for offline in (False, True)
+        ]
+        rendered = await caldav_to_org.render_calendars(config, True, session)
+        books = await caldav_to_org.get_resource(config, "addressbooks", True)
+        stale = caldav_to_org.stale_copy(url.replace("/cal", "/book"))
+        return [*streamed, rendered], [books, [stale]]
+
+    calendars, books = serve(app, fetch_all)
+    for entries in calendars:
+        assert entries[0].startswith("* Feed the Jürgen")
+    for book in books:
+        assert list(cards2org.org_contacts(book))[0].startswith("* Jürgen")
+    # Undeclared charsets degrade like the icalendar parser
+    (contact,) = cards2org.org_contacts([latin["book"]])
+    assert contact.startswith("* J\ufffdrgen")
+
+
+def test_card_sync(cache):
+    books = [
+        {"/cal/a.vcf": ('"1"', "Ada"), "/cal/b.vcf": ('"1"', "Bob")},
+        {"/cal/a.vcf": ('"1"', "Ada"), "/cal/c.vcf": ('"1"', "Cid")},
+        {"/cal/a.vcf": ('"2"', "Ann"), "/cal/c.vcf": ('"1"', "Cid")},
+    ]
+    asked = []
+
+    async def propfind(request):
+        book = books[0]
+        return web.Response(
+            status=207, text=card_listing(*((h, e) for h, (e, _) in book.items()))
+        )
+
+    async def report(request):
+        body = await request.text()
+        hrefs = re.findall("<D:href>(.*)</D:href>", body)
+        asked.append(hrefs)
+        found = "".join(
+            f"<D:response><D:href>{href}</D:href><D:propstat><D:prop>"
+            f"<D:getetag>{books[0][href][0]}</D:getetag>"
+            f"<A:address-data>{vcard(books[0][href][1])}</A:address-data>"
+            "</D:prop><D:status>HTTP/1.1 200 OK</D:status></D:propstat>"
+            "</D:response>"
+            for href in hrefs
+        )
+        return web.Response(
+            status=207,
+            text='<D:multistatus xmlns:D="DAV:" '
+            f'xmlns:A="urn:ietf:params:xml:ns:carddav">{found}</D:multistatus>',
+        )
+
+    app = web.Application()
+    app.router.add_route("PROPFIND", "/cal", propfind)
+    app.router.add_route("REPORT", "/cal", report)
+    section = {"user": "me", "passwordstore": "cal"}
+
+    async def three_syncs(url, session):
+        results = []
+        for _ in range(3):
+            results.append(
+                await caldav_to_org.card_sync(url, section, False, session)
+            )
+            books.pop(0)
+        return results
+
+    first, second, third = serve(app, three_syncs)
+    assert [entry.splitlines()[0] for entry in first] == ["* Ada", "* Bob"]
+    assert [entry.splitlines()[0] for entry in second] == ["* Ada", "* Cid"]
+    assert [entry.splitlines()[0] for entry in third] == ["* Ann", "* Cid"]
+    assert asked == [["/cal/a.vcf", "/cal/b.vcf"], ["/cal/c.vcf"], ["/cal/a.vcf"]]
+    assert list(cards2org.org_contacts([third])) == third
+
+
+def test_update_fetches_calendars_and_contacts_together(cache, monkeypatch):
+    daily = CALENDAR.replace("END:VEVENT", "RRULE:FREQ=DAILY\nEND:VEVENT")
+    bodies = {"cal": daily, "book": vcard("Ada")}
+    requests, sessions = [], []
+
+    async def resource(request):
+        requests.append(request.match_info["name"])
+        await asyncio.sleep(0.2)
+        return web.Response(text=bodies[request.match_info["name"]])
+
+    client_session = caldav_to_org.client_session
+
+    def counted_session(config):
+        sessions.append(config)
+        return client_session(config)
+
+    monkeypatch.setattr(caldav_to_org, "client_session", counted_session)
+    app = web.Application()
+    app.router.add_get("/{name}", resource)
+    args = argparse.Namespace(
+        url=None, stream=False, contacts=True, force=False, offline=False, jobs=1
+    )
+
+    async def update(url, session):
+        config = configparser.ConfigParser()
+        config.read_dict(
+            {
+                "DEFAULT": {
+                    "agenda_outfile": str(cache / "agenda.org"),
+                    "contacts_outfile": str(cache / "contacts.org"),
+                },
+                "server": {
+                    "url": url.replace("/cal", "/{}"),
+                    "calendars": "cal",
+                    "addressbooks": "book",
+                    "user": "me",
+                    "passwordstore": "cal",
+                },
+            }
+        )
+        start = asyncio.get_running_loop().time()
+        await caldav_to_org.update(config, args)
+        return asyncio.get_running_loop().time() - start
+
+    elapsed = serve(app, update)
+    assert sorted(requests) == ["book", "cal"] and len(sessions) == 1
+    # one after the other they would take 0.4 s
+    assert elapsed < 0.4
+    assert (cache / "agenda.org").read_text().startswith("* Feed the dragons")
+    assert (cache / "contacts.org").read_text().startswith("* Ada")
+
+
+def test_url_keeps_agenda_caches(cache, capsys):
+    daily = CALENDAR.replace("END:VEVENT", "RRULE:FREQ=DAILY\nEND:VEVENT")
+
+    async def calendar(request):
+        return web.Response(text=daily.replace("dragons", request.match_info["name"]))
+
+    app = web.Application()
+    app.router.add_get("/{name}", calendar)
+    args = argparse.Namespace(
+        url=None, stream=False, force=False, offline=False, jobs=1
+    )
+
+    async def render(url, session):
+        config = resource_config(url, agenda_outfile=str(cache / "agenda.org"))
+        await caldav_to_org.write_agenda(config, args, session)
+        stored = {path: path.stat().st_size for path in cache.glob("agenda-*")}
+        args.url = url.replace("/cal", "/other")
+        await caldav_to_org.write_agenda(config, args, session)
+        return stored
+
+    stored = serve(app, render)
+    assert capsys.readouterr().out.startswith("* Feed the other")
+    assert {path: path.stat().st_size for path in cache.glob("agenda-*")} == stored
+
+
+def test_calendars_parse_while_others_download(cache, monkeypatch):
+    daily = CALENDAR.replace("END:VEVENT", "RRULE:FREQ=DAILY\nEND:VEVENT")
+    delays = {"slow": 0.3, "fast": 0}
+    finished, parsed = {}, {}
+
+    async def calendar(request):
+        name = request.match_info["name"]
+        await asyncio.sleep(delays[name])
+        finished[name] = time.monotonic()
+        text = daily.replace("dragons", name).replace("UID:first", f"UID:{name}")
+        return web.Response(text=text)
+
+    calendar_records = ical2org.calendar_records
+
+    def timed_records(text, *args):
+        parsed["slow" if b"slow" in text else "fast"] = time.monotonic()
+        return calendar_records(text, *args)
+
+    monkeypatch.setattr(ical2org, "calendar_records", timed_records)
+    app = web.Application()
+    app.router.add_get("/{name}", calendar)
+
+    async def render(url, session):
+        config = resource_config(url)
+        config["server"]["calendars"] = "slow fast"
+        return await caldav_to_org.render_calendars(config, False, session)
+
+    entries = serve(app, render)
+    assert [entry.splitlines()[0] for entry in entries] == [
+        "* Feed the slow  :rrule:",
+        "* Feed the fast  :rrule:",
+    ]
+    assert parsed["fast"] < finished["slow"] <= parsed["slow"]
+
+
+def test_download_counters(cache):
+    STATS.enabled = True
+    STATS.reset()
+
+    async def render(url, session):
+        config = resource_config(url)
+        return await caldav_to_org.render_calendars(config, False, session)
+
+    try:
+        serve(calendar_app([]), render)
+        counters = STATS.take()["counters"]
+    finally:
+        STATS.enabled = False
+        STATS.reset()
+    assert counters["bytes_downloaded"] == len(BODY)
+    assert counters["download_cache_misses"] == 1
+    assert counters["events_parsed"] == 1
@@ -0,0 +1,58 @@
+import gzip
+import os
+
+from caldav_to_org.downloads import DownloadCache
+
+
+def test_entries_are_compressed_with_metadata(tmp_path):
+    cache = DownloadCache(str(tmp_path))
+    text = "BEGIN:VCALENDAR\r\n" + "SUMMARY:Feed the dragons\r\n" * 1000
+    cache.put("https://example.com/cal", text, {"ETag": '"v1"', "Server": "x"})
+
+    assert cache.get("https://example.com/cal") == text
+    assert cache.validators("https://example.com/cal") == {"If-None-Match": '"v1"'}
+    meta = cache.meta("https://example.com/cal")
+    assert meta["url"] == "https://example.com/cal" and meta["size"] == len(text)
+    body = cache.path("https://example.com/cal")
+    assert os.path.getsize(body) < len(text) / 10
+    assert gzip.decompress(open(body, "rb").read()).decode() == text
+    assert cache.get("https://example.com/other") is None
+
+
+def test_max_age(tmp_path):
+    cache = DownloadCache(str(tmp_path))
+    cache.put("cal", "text")
+    assert cache.get("cal", max_age=60) == "text"
+    meta = cache.meta("cal")
+    meta["fetched"] -= 120
+    cache.write_meta("cal", meta)
+    assert cache.get("cal", max_age=60) is None
+    cache.touch("cal")
+    assert cache.get("cal", max_age=60) == "text"
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    cache = DownloadCache(str(tmp_path), max_size=4000)
+    for index, url in enumerate(["a", "b", "c"]):
+        cache.put(url, os.urandom(1000).hex())
+        os.utime(cache.path(url), (index, index))
+    cache.get("a")
+
+    cache.put("d", os.urandom(1000).hex())
+    assert [cache.fresh(url) for url in "abcd"] == [True, False, True, True]
+
+
+def test_failed_write_keeps_the_entry(tmp_path):
+    cache = DownloadCache(str(tmp_path))
+    cache.put("cal", "old")
+    try:
+        with cache.writer("cal") as fid:
+            fid.write(b"new")
+            raise ConnectionError
+    except ConnectionError:
+        pass
+    assert cache.get("cal") == "old"
+    body = cache.path("cal")
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        os.path.basename(path) for path in (body, cache.meta_path(body))
+    )
@@ -4,9 +4,10 @@ from contextlib import contextmanager
 
 import pytest
 from freezegun import freeze_time
+from tzlocal import reload_localzone
 
 from icalendar import Calendar
-from org_agenda import ical2org
+from caldav_to_org import ical2org
 
 
 @contextmanager
@@ -15,17 +16,17 @@ def on_date(date, timezone):
 
     os.environ["TZ"] = timezone
     time.tzset()
+    reload_localzone()
     with freeze_time(date):
         yield
     os.environ.pop("TZ")
     time.tzset()
+    reload_localzone()
 
 
-@pytest.mark.parametrize(
-    "ics, result",
-    [
-        pytest.param(
-            """BEGIN:VCALENDAR
+CASES = [
+    pytest.param(
+        """BEGIN:VCALENDAR
 BEGIN:VEVENT
 UID:first
 SUMMARY:Feed the dragons
@@ -37,17 +38,17 @@ CATEGORIES:pets,dragons
 CATEGORIES:shopping
 END:VEVENT
 END:VCALENDAR""",
-            """* Feed the dragons  :pets:dragons:shopping:
+        """* Feed the dragons  :pets:dragons:shopping:
 :PROPERTIES:
 :LOCATION: forest
 :ID: first
 :END:
   <2020-03-19 Thu 10:30>--<2020-03-19 Thu 11:30>
 take some meat""",
-            id="simple event",
-        ),
-        pytest.param(
-            """BEGIN:VCALENDAR
+        id="simple event",
+    ),
+    pytest.param(
+        """BEGIN:VCALENDAR
 BEGIN:VEVENT
 DTSTART:20200319T173000Z
 DTEND:20200319T181500Z
@@ -63,7 +64,7 @@ DESCRIPTION:Reminder
 END:VALARM
 END:VEVENT
 END:VCALENDAR""",
-            """* Go hunting
+        """* Go hunting
 :PROPERTIES:
 :LOCATION: big forest
 :ID: second
@@ -71,25 +72,25 @@ END:VCALENDAR""",
 :END:
   <2020-03-19 Thu 18:30>--<2020-03-19 Thu 19:15>
  Search for big animals that are on the open""",
-            id="Multiline description",
-        ),
-        pytest.param(
-            """BEGIN:VEVENT
+        id="Multiline description",
+    ),
+    pytest.param(
+        """BEGIN:VEVENT
 UID:fullday
 SUMMARY:Home day
 DTSTART;VALUE=DATE:20200312
 DTEND;VALUE=DATE:20200313
 CATEGORIES:cleanup
 END:VEVENT""",
-            """* Home day  :cleanup:
+        """* Home day  :cleanup:
 :PROPERTIES:
 :ID: fullday
 :END:
   <2020-03-12 Thu>""",
-            id="Full day",
-        ),
-        pytest.param(
-            """BEGIN:VEVENT
+        id="Full day",
+    ),
+    pytest.param(
+        """BEGIN:VEVENT
 UID:forthofmonth
 DTSTART;TZID=Europe/Berlin:20200125T190000
 DTEND;TZID=Europe/Berlin:20200125T210000
@@ -97,17 +98,17 @@ SUMMARY:Monthly meeting
 RRULE:FREQ=MONTHLY;BYDAY=WE;BYSETPOS=4
 EXDATE;TZID=Europe/Berlin:20200325T190000
 END:VEVENT""",
-            """* Monthly meeting  :rrule:
+        """* Monthly meeting  :rrule:
 :PROPERTIES:
 :ID: forthofmonth
 :RRULE: FREQ=MONTHLY;BYDAY=WE;BYSETPOS=4
 :END:
   <2020-02-26 Wed 19:00>--<2020-02-26 Wed 21:00>
   <2020-04-22 Wed 19:00>--<2020-04-22 Wed 21:00>""",
-            id="repetitions 4th wed of month with exception",
-        ),
-        pytest.param(
-            """BEGIN:VEVENT
+        id="repetitions 4th wed of month with exception",
+    ),
+    pytest.param(
+        """BEGIN:VEVENT
 DTSTAMP:20191226T190839Z
 UID:J480MNXCKM88LL7UQ2ITQX
 SUMMARY:travel
@@ -120,7 +121,7 @@ TRIGGER:-PT60M
 END:VALARM
 END:VEVENT
 """,
-            """* travel  :rrule:
+        """* travel  :rrule:
 :PROPERTIES:
 :LOCATION: train
 :ID: J480MNXCKM88LL7UQ2ITQX
@@ -137,10 +138,10 @@ END:VEVENT
   <2020-04-09 Thu 19:00>--<2020-04-09 Thu 22:00>
   <2020-04-16 Thu 19:00>--<2020-04-16 Thu 22:00>
   <2020-04-23 Thu 19:00>--<2020-04-23 Thu 22:00>""",
-            id="duration and weekly repeat",
-        ),
-        pytest.param(
-            """BEGIN:VCALENDAR
+        id="duration and weekly repeat",
+    ),
+    pytest.param(
+        """BEGIN:VCALENDAR
 BEGIN:VEVENT
 UID:835f0339-d824-42f4-9e1e-82b45229d75d
 DTSTART;TZID=Europe/Berlin:20200419T130000
@@ -179,7 +180,7 @@ SUMMARY:Daily later
 RECURRENCE-ID;TZID=Europe/Berlin:20200421T120010
 END:VEVENT
 END:VCALENDAR""",
-            """* Crisis  :rrule:
+        """* Crisis  :rrule:
 :PROPERTIES:
 :ID: 835f0339-d824-42f4-9e1e-82b45229d75d
 :RRULE: FREQ=DAILY;UNTIL=20200425T220000Z
@@ -219,10 +220,12 @@ END:VCALENDAR""",
 :ID: e5a638dc-3125-454b-856d-60d3015bed2e
 :END:
   <2020-04-21 Tue 15:00>--<2020-04-21 Tue 16:00>""",
-            id="many changes",
-        ),
-    ],
-)
+        id="many changes",
+    ),
+]
+
+
+@pytest.mark.parametrize("ics, result", CASES)
 @on_date("2020-03-19", "Europe/Berlin")
 def test_conversion(ics, result):
     events = "\n\n".join(ical2org.org_events([ics], 40, 30))
@@ -230,6 +233,20 @@ def test_conversion(ics, result):
     assert events == result
 
 
+@pytest.mark.parametrize("ics, result", CASES)
+@on_date("2020-03-19", "Europe/Berlin")
+def test_parsed_cache(ics, result, tmp_path, monkeypatch):
+    events = "\n\n".join(ical2org.org_events([ics], 40, 30, tmp_path))
+    assert events == result
+
+    def no_parsing(text):
+        raise AssertionError("Cached calendar parsed again")
+
+    monkeypatch.setattr(Calendar, "from_ical", no_parsing)
+    events = "\n\n".join(ical2org.org_events([ics], 40, 30, tmp_path))
+    assert events == result
+
+
 @pytest.mark.parametrize(
     "ics, result",
     [
@@ -259,3 +276,200 @@ def test_conversion_2(ics, result):
     events = "\n\n".join(ical2org.org_events([ics], 40, 30))
     print(events)
     assert events == result
+
+
+def test_render_cache(tmp_path, monkeypatch):
+    ics = CASES[4].values[0]
+    renders = []
+    render = ical2org.render
+
+    def counted_render(*args):
+        renders.append(args)
+        return render(*args)
+
+    monkeypatch.setattr(ical2org, "render", counted_render)
+
+    def events(date):
+        with on_date(date, "Europe/Berlin"):
+            return list(ical2org.org_events([ics], 40, 30, tmp_path))
+
+    first = events("2020-03-19 08:00")
+    assert len(renders) == 1
+    # No occurrence enters or leaves the window
+    assert events("2020-03-21 08:00") == first
+    assert len(renders) == 1
+    # The occurrence of 2020-02-20 leaves the window
+    moved = events("2020-03-22 08:00")
+    assert len(renders) == 2
+    assert "2020-02-20" not in moved[0]
+    assert "2020-04-30" in moved[0]
+
+
+@pytest.mark.parametrize("ics, result", CASES)
+@on_date("2020-03-19", "Europe/Berlin")
+def test_event_stream(ics, result):
+    events = ical2org.EventStream(*ical2org.window(40, 30))
+    entries = [entry for line in ics.splitlines() for entry in events.feed(line)]
+    entries.extend(events.close())
+    assert sorted(entries) == sorted(result.split("\n\n"))
+
+
+@on_date("2020-03-19", "Europe/Berlin")
+def test_parallel_jobs(tmp_path):
+    calendars = [case.values[0] for case in CASES]
+    serial = list(ical2org.org_events(calendars, 40, 30))
+    assert list(ical2org.org_events(calendars, 40, 30, jobs=2)) == serial
+    assert list(ical2org.org_events(calendars, 40, 30, tmp_path, jobs=3)) == serial
+    assert list(ical2org.org_events(calendars, 40, 30, tmp_path, jobs=3)) == serial
+
+
+@on_date("2020-03-19", "Europe/Berlin")
+def test_window_prefilter(monkeypatch):
+    ics = """BEGIN:VCALENDAR
+BEGIN:VEVENT
+UID:old
+SUMMARY:Long gone
+DTSTART:20150319T103000Z
+DTEND:20150319T113000Z
+END:VEVENT
+BEGIN:VEVENT
+UID:later
+SUMMARY:Far ahead
+DTSTART;VALUE=DATE:20210101
+DURATION:P1D
+END:VEVENT
+BEGIN:VEVENT
+UID:counted
+SUMMARY:Finished series
+DTSTART:20190101T103000Z
+DURATION:PT1H
+RRULE:FREQ=WEEKLY;COUNT=10
+END:VEVENT
+BEGIN:VEVENT
+UID:moved
+SUMMARY:Ended series
+DTSTART:20190101T103000Z
+DURATION:PT1H
+RRULE:FREQ=DAILY;UNTIL=20190201T000000Z
+END:VEVENT
+BEGIN:VEVENT
+UID:moved
+SUMMARY:Postponed occurrence
+RECURRENCE-ID:20190110T103000Z
+DTSTART:20200320T103000Z
+DURATION:PT1H
+END:VEVENT
+END:VCALENDAR"""
+    built = []
+    org_event = ical2org.OrgEvent
+
+    def counted_event(record):
+        built.append(record["SUMMARY"])
+        return org_event(record)
+
+    monkeypatch.setattr(ical2org, "OrgEvent", counted_event)
+    entries = list(ical2org.org_events([ics], 40, 30))
+    assert built == ["Ended series", "Postponed occurrence"]
+    assert len(entries) == 1
+    assert entries[0].startswith("* Postponed occurrence")
+    assert "<2020-03-20 Fri 11:30>--<2020-03-20 Fri 12:30>" in entries[0]
+
+
+@on_date("2020-03-19", "Europe/Berlin")
+def test_calendar_streams(monkeypatch):
+    records = ical2org.parse(CASES[0].values[0]) + ical2org.parse(CASES[5].values[0])
+    renders = []
+    render = ical2org.render
+
+    def counted_render(records, start, end):
+        renders.append([record["SUMMARY"] for record in records])
+        return render(records, start, end)
+
+    monkeypatch.setattr(ical2org, "render", counted_render)
+    entries = ical2org.org_calendar(records, *ical2org.window(40, 30))
+    assert next(entries).startswith("* Feed the dragons")
+    assert renders == [["Feed the dragons"]]
+    assert len(list(entries)) == 5
+    assert renders[1:] == [
+        ["Crisis", "Crisis Management", "Crisis Breakdown"],
+        ["Daily", "Daily later"],
+    ]
+    assert not hasattr(ical2org.OrgEvent(records[0]), "__dict__")
+
+
+def shared_event(summary, sequence, modified, recurrence_id=""):
+    "Copy of a shared repeating event, or of one of its changed occurrences"
+    return f"""BEGIN:VCALENDAR
+BEGIN:VEVENT
+UID:shared
+SUMMARY:{summary}
+DTSTART:20200320T103000Z
+DURATION:PT1H
+{recurrence_id or "RRULE:FREQ=DAILY;COUNT=3"}
+SEQUENCE:{sequence}
+LAST-MODIFIED:{modified}
+END:VEVENT
+END:VCALENDAR"""
+
+
+@pytest.mark.parametrize(
+    "policy, kept",
+    [
+        ("sequence", "Newer sequence"),
+        ("last-modified", "Modified later"),
+        ("first", "First copy"),
+    ],
+)
+@on_date("2020-03-19", "Europe/Berlin")
+def test_duplicates_across_calendars(policy, kept):
+    calendars = [
+        shared_event("First copy", 0, "20200101T000000Z"),
+        shared_event("Newer sequence", 2, "20200102T000000Z"),
+        shared_event("Modified later", 1, "20200301T000000Z"),
+    ]
+    (entry,) = ical2org.org_events(calendars, 40, 30, policy=policy)
+    assert entry.startswith(f"* {kept}")
+    assert entry.count("\n  <2020-03-2") == 3
+
+
+@on_date("2020-03-19", "Europe/Berlin")
+def test_duplicates_keep_changed_occurrences_together():
+    moved = "RECURRENCE-ID:20200321T103000Z"
+    calendars = [
+        ical2org.parse(shared_event("Daily", 0, "20200101T000000Z")),
+        ical2org.parse(CASES[0].values[0]),
+        ical2org.parse(shared_event("Moved", 1, "20200102T000000Z", moved)),
+    ]
+    unique = ical2org.unique_events(calendars)
+    assert [[record["SUMMARY"] for record in records] for records in unique] == [
+        ["Daily", "Moved"],
+        ["Feed the dragons"],
+        [],
+    ]
+    with pytest.raises(ValueError):
+        ical2org.unique_events(calendars, "oldest")
+
+
+@on_date("2020-03-19", "Europe/Berlin")
+def test_parallel_identical_calendars(tmp_path):
+    events = "".join(
+        f"BEGIN:VEVENT\nUID:{uid}\nSUMMARY:Event {uid}\n"
+        f"DTSTART:20200320T1030{uid % 60:02d}Z\nDURATION:PT1H\nEND:VEVENT\n"
+        for uid in range(500)
+    )
+    calendars = [f"BEGIN:VCALENDAR\n{events}END:VCALENDAR"] * 6
+    entries = list(ical2org.org_events(calendars, 40, 30, tmp_path, jobs=4))
+    assert len(entries) == 500
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+
+@on_date("2020-03-19", "Europe/Berlin")
+def test_parsed_cache_keeps_current_calendars(tmp_path):
+    for edit in range(5):
+        calendars = [
+            CASES[0].values[0].replace("meat", f"meat {edit}"),
+            CASES[1].values[0],
+        ]
+        list(ical2org.org_events(calendars, 40, 30, tmp_path))
+    stored = [name for name in os.listdir(tmp_path) if "events" in name]
+    assert len(stored) == 2
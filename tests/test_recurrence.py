@@ -0,0 +1,99 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from dateutil import tz
+from dateutil.rrule import rrulestr
+
+from caldav_to_org import recurrence
+
+BERLIN = tz.gettz("Europe/Berlin")
+
+
+def random_rule(rand):
+    "Random simple repetition rule text"
+    freq = rand.choice(["DAILY", "WEEKLY", "MONTHLY", "YEARLY"])
+    parts = [f"FREQ={freq}"]
+    if rand.random() < 0.6:
+        parts.append(f"INTERVAL={rand.randint(1, 4)}")
+    if freq == "WEEKLY" and rand.random() < 0.7:
+        days = rand.sample(recurrence.WEEKDAYS, rand.randint(1, 4))
+        parts.append(f"BYDAY={','.join(days)}")
+    if freq == "WEEKLY" and rand.random() < 0.3:
+        parts.append(f"WKST={rand.choice(recurrence.WEEKDAYS)}")
+    limit = rand.random()
+    if limit < 0.3:
+        parts.append(f"COUNT={rand.randint(1, 300)}")
+    elif limit < 0.6:
+        until = datetime(2021, 1, 1, tzinfo=timezone.utc) + timedelta(
+            rand.randint(0, 3000), hours=rand.randint(0, 23)
+        )
+        parts.append(f"UNTIL={until:%Y%m%dT%H%M%SZ}")
+    return ";".join(parts)
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_same_as_dateutil(seed):
+    rand = random.Random(seed)
+    rule_text = random_rule(rand)
+    dtstart = datetime(2015, 1, 1, rand.randint(0, 23), 30, tzinfo=BERLIN)
+    dtstart += timedelta(rand.randint(0, 3000))
+    if "FREQ=MONTHLY" in rule_text or "FREQ=YEARLY" in rule_text:
+        dtstart = dtstart.replace(day=min(dtstart.day, 28))
+    start = datetime(2019, 1, 1, tzinfo=timezone.utc) + timedelta(
+        rand.randint(0, 2000), hours=rand.randint(0, 23)
+    )
+    end = start + timedelta(rand.randint(1, 120))
+
+    expected = rrulestr(rule_text, dtstart=dtstart, forceset=True)
+    occurrences = expected.between(dtstart - timedelta(1), end)
+    exdates = set(rand.sample(occurrences, min(len(occurrences), 3)))
+    for exdate in exdates:
+        expected.exdate(exdate)
+
+    fast = recurrence.simple_rule(rule_text, dtstart, exdates)
+    assert fast is not None, rule_text
+    assert fast.between(start, end) == expected.between(start, end), rule_text
+    assert fast.between(start, end, inc=True) == expected.between(
+        start, end, inc=True
+    )
+    assert fast.after(start) == expected.after(start)
+    assert fast.after(end, inc=True) == expected.after(end, inc=True)
+
+
+@pytest.mark.parametrize(
+    "rule_text",
+    [
+        "FREQ=MONTHLY;BYDAY=WE;BYSETPOS=4",
+        "FREQ=MONTHLY;BYDAY=2MO",
+        "FREQ=YEARLY;BYMONTH=3",
+        "FREQ=WEEKLY;INTERVAL=2;BYDAY=MO;UNTIL=20200904",
+    ],
+)
+def test_exotic_rules_use_dateutil(rule_text):
+    dtstart = datetime(2020, 1, 6, 10, tzinfo=BERLIN)
+    assert recurrence.simple_rule(rule_text, dtstart, set()) is None
+
+
+@pytest.mark.parametrize("seed", range(100))
+def test_last_start_bounds_occurrences(seed):
+    rand = random.Random(seed)
+    rule_text = random_rule(rand)
+    dtstart = datetime(2015, 1, 1, rand.randint(0, 23), 30, tzinfo=BERLIN)
+    dtstart += timedelta(rand.randint(0, 3000))
+    if "FREQ=MONTHLY" in rule_text or "FREQ=YEARLY" in rule_text:
+        dtstart = dtstart.replace(day=min(dtstart.day, 28))
+
+    last = recurrence.last_start(rule_text, dtstart)
+    if "COUNT" not in rule_text and "UNTIL" not in rule_text:
+        assert last is None
+        return
+    occurrences = list(rrulestr(rule_text, dtstart=dtstart))
+    assert not occurrences or occurrences[-1] <= last, rule_text
+
+
+def test_last_start_unknown():
+    dtstart = datetime(2020, 1, 31, 10, tzinfo=BERLIN)
+    assert recurrence.last_start("FREQ=MONTHLY;COUNT=3", dtstart) is None
+    assert recurrence.last_start("FREQ=YEARLY;BYMONTH=3;COUNT=3", dtstart) is None
+    assert recurrence.last_start("FREQ=WEEKLY;UNTIL=20200904", dtstart) is None
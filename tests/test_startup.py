@@ -0,0 +1,31 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+HEAVY = ("aiohttp", "requests", "icalendar", "vobject", "dateutil", "tzlocal")
+
+
+def loaded(module):
+    "Heavy dependencies loaded by a fresh interpreter importing MODULE"
+    script = (
+        f"import sys, json, {module}\n"
+        f"print(json.dumps([name for name in {HEAVY!r} if name in sys.modules]))"
+    )
+    reply = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True, check=True
+    )
+    return set(json.loads(reply.stdout))
+
+
+@pytest.mark.parametrize(
+    "module, allowed",
+    [
+        ("caldav_to_org", set()),
+        ("caldav_to_org.ical2org", {"dateutil", "tzlocal"}),
+        ("caldav_to_org.cards2org", {"dateutil", "vobject"}),
+    ],
+)
+def test_import_budget(module, allowed):
+    assert loaded(module) <= allowed
@@ -0,0 +1,85 @@
+import configparser
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+import caldav_to_org
+from caldav_to_org import ical2org
+from caldav_to_org.stats import STATS, Stats
+
+
+def test_disabled_stats_record_nothing():
+    stats = Stats()
+    with stats.stage("parse", "https://example.com/cal"):
+        stats.count("events_parsed", 3)
+    assert stats.take() == {"stages": {}, "urls": {}, "counters": {}}
+
+
+def test_merge_and_report(tmp_path):
+    stats, worker = Stats(), Stats()
+    stats.enabled = worker.enabled = True
+    with stats.stage("download", "https://example.com/cal"):
+        stats.count("bytes_downloaded", 100)
+    with worker.stage("render"):
+        worker.count("events_emitted", 2)
+    stats.merge(worker.take())
+
+    report = tmp_path / "stats.json"
+    stats.report(str(report))
+    data = json.loads(report.read_text())
+    assert set(data["stages"]) == {"download", "render"}
+    assert set(data["urls"]["https://example.com/cal"]) == {"download"}
+    assert data["counters"] == {"bytes_downloaded": 100, "events_emitted": 2}
+    assert stats.take()["counters"] == {}
+
+
+@pytest.fixture
+def enabled_stats():
+    "Measure with the global STATS during the test"
+    STATS.enabled = True
+    STATS.reset()
+    yield STATS
+    STATS.enabled = False
+    STATS.reset()
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_pipeline_counters(enabled_stats, tmp_path, jobs):
+    start = datetime.now(timezone.utc).strftime("%Y%m%dT100000Z")
+    calendars = [
+        f"BEGIN:VCALENDAR\nBEGIN:VEVENT\nUID:{name}\nSUMMARY:{name}\n"
+        f"DTSTART:{start}\nDURATION:PT1H\nRRULE:FREQ=DAILY;COUNT=5\n"
+        "END:VEVENT\nEND:VCALENDAR"
+        for name in ("feed", "hunt")
+    ]
+    config = configparser.ConfigParser()
+    config["DEFAULT"]["agenda_outfile"] = str(tmp_path / "agenda.org")
+
+    enabled_stats.count("bytes_downloaded", 7)
+    for _ in range(2):
+        events = ical2org.org_events(calendars, 10, 1, tmp_path, jobs=jobs)
+        caldav_to_org.save_events(config, events)
+
+    # Counted in the worker thread or processes, merged with the others
+    counters = enabled_stats.take()["counters"]
+    assert counters["bytes_downloaded"] == 7
+    assert counters["parse_cache_misses"] == 2
+    assert counters["parse_cache_hits"] == 2
+    assert counters["events_parsed"] == 2
+    assert counters["occurrences_expanded"] == 10
+    assert counters["render_cache_misses"] == 2
+    assert counters["render_cache_hits"] == 2
+    assert counters["events_emitted"] == 4
+
+
+def test_measurements_stay_out_of_workers(enabled_stats):
+    calendar = (
+        "BEGIN:VCALENDAR\nBEGIN:VEVENT\nUID:feed\nSUMMARY:feed\n"
+        "DTSTART:20200301T100000Z\nEND:VEVENT\nEND:VCALENDAR"
+    )
+    enabled_stats.count("bytes_downloaded", 7)
+    # Parsing in a thread of the main process leaves the counters to it
+    records, measured = ical2org.calendar_records(calendar)
+    assert len(records) == 1 and measured is None
+    assert enabled_stats.counters == {"bytes_downloaded": 7, "events_parsed": 1}
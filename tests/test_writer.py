@@ -0,0 +1,58 @@
+import logging
+import os
+
+import pytest
+
+from caldav_to_org.writer import OrgWriter
+
+
+def write(path, entries):
+    with OrgWriter(str(path)) as writer:
+        for entry in entries:
+            writer.write(entry)
+    return writer
+
+
+def test_repeated_entries_are_written_once(tmp_path):
+    path = tmp_path / "agenda.org"
+    writer = write(path, ["* one", "* two", "* one", "* über"])
+    assert path.read_text(encoding="UTF-8") == "* one\n\n* two\n\n* über\n"
+    assert writer.entries == 3 and writer.changed
+
+
+def test_unchanged_file_is_not_rewritten(tmp_path):
+    path = tmp_path / "agenda.org"
+    write(path, ["* one", "* two"])
+    os.chmod(path, 0o600)
+    before = os.stat(path)
+
+    assert not write(path, ["* one", "* two"]).changed
+    assert os.stat(path).st_ino == before.st_ino
+    assert os.listdir(tmp_path) == ["agenda.org"]
+
+    assert write(path, ["* one", "* three"]).changed
+    assert path.read_text() == "* one\n\n* three\n"
+    assert os.stat(path).st_mode == before.st_mode
+
+
+def test_unchanged_file_is_logged_verbosely(tmp_path, caplog):
+    # As set by -v
+    caplog.set_level(logging.INFO, logger="Org_calendar")
+    path = tmp_path / "agenda.org"
+    write(path, ["* one"])
+    write(path, ["* one"])
+    assert caplog.messages == [f"Unchanged: {path}"]
+
+
+def test_failure_keeps_the_old_file(tmp_path):
+    path = tmp_path / "agenda.org"
+    write(path, ["* one"])
+
+    def entries():
+        yield "* two"
+        raise RuntimeError("broken calendar")
+
+    with pytest.raises(RuntimeError):
+        write(path, entries())
+    assert path.read_text() == "* one\n"
+    assert os.listdir(tmp_path) == ["agenda.org"]